@@ -15,6 +15,7 @@ from datetime import datetime, timedelta
 from functools import partial
 import webutil
 import ipaddress
+import asyncio
 
 class CORSBlessMixin(object):
     """ Implements HTTP OPTIONS to allow requests via XHR on modern browsers. """
@@ -27,7 +28,7 @@ class CORSBlessMixin(object):
 
 @route("/api/v1/read_tl")
 class TranslateReadAPI(CORSBlessMixin, tornado.web.RequestHandler):
-    """ Queries database for cs translation entries """
+    """ Looks up cs translation entries in tle's in-memory replica """
 
     # @tornado.web.asynchronous
     async def post(self):
@@ -48,17 +49,70 @@ class TranslateReadAPI(CORSBlessMixin, tornado.web.RequestHandler):
         if not unique:
             self.set_header("Content-Type", "application/json; charset=utf-8")
             self.write("{}")
-            self.finish()
+            return self.finish()
 
-        self.settings["tle"].translate(self.complete, *unique)
+        try:
+            found = await self.settings["tle"].replica.lookup(unique)
+        except (ValueError, asyncio.TimeoutError):
+            self.set_status(503)
+            self.write({"error": "translations can't be read right now"})
+            return self.finish()
 
-    def complete(self, ret):
-        from_db = {tlo.key: tlo.english for tlo in ret if tlo.english != tlo.key}
+        self.complete(found)
+
+    def complete(self, from_db):
         self.set_header("Content-Type", "application/json; charset=utf-8")
         json.dump(from_db, self, ensure_ascii=0)
         self.finish()
 
 
+@route("/api/v1/tl_dump")
+class TranslateDumpAPI(CORSBlessMixin, tornado.web.RequestHandler):
+    """ Every translation in one GET. With ?since=<revision>, only what
+        changed after it (keys that lost their translation map to null).
+        The response's revision goes in the next ?since. """
+
+    async def get(self):
+        self.set_cors_policy()
+
+        since = self.get_argument("since", None)
+        try:
+            since = None if since is None else int(since)
+        except ValueError:
+            self.set_status(400)
+            return self.finish()
+
+        dump = self.settings["tle"].dump
+        snapshot = None
+        try:
+            if since is not None:
+                snapshot = await dump.delta(since)
+            # A revision from before the table was cleared gets everything.
+            if snapshot is None:
+                since = None
+                snapshot = await dump.get()
+        except (ValueError, asyncio.TimeoutError):
+            snapshot = None
+
+        if snapshot is None:
+            self.set_status(503)
+            return self.finish()
+
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.set_header("Vary", "Accept-Encoding")
+        self.set_header("ETag", '"{0}"'.format(snapshot.revision if since is None else
+            "{0}-{1}".format(snapshot.revision, since)))
+        if self.check_etag_header():
+            self.set_status(304)
+            return self.finish()
+
+        if "gzip" in self.request.headers.get("Accept-Encoding", ""):
+            self.set_header("Content-Encoding", "gzip")
+            self.write(snapshot.gzipped)
+        else:
+            self.write(snapshot.body)
+        self.finish()
+
 @route("/api/v1/send_tl")
 class TranslateWriteAPI(tornado.web.RequestHandler):
     """ Save a contributed string to database.
@@ -116,19 +170,14 @@ class TranslateWriteAPI(tornado.web.RequestHandler):
         else:
             s = key
 
-        self.settings["tle"].set_translation(
-            key, s, self.request.remote_ip)
+        if not self.settings["tle"].queue_translation(key, s, self.request.remote_ip):
+            self.set_status(503)
+            return
         self.settings["analytics"].analyze_request(self.request, self.__class__.__name__,
                                                    {"key": key, "value": s})
 
-class objproxy(object):
-    def __init__(self, d):
-        self.d = d
-    def __getattr__(self, key):
-        return self.d[key]
-
 def extend_skill(self, d):
-    d["explain_en"] = starlight.en.describe_skill(objproxy(d))
+    d["explain_en"] = d["description"]
     d["skill_type_id"] = d["skill_type"]
     d["skill_type"] = enums.skill_type(d["skill_type"])
 
@@ -144,7 +193,7 @@ def extend_skill(self, d):
     del d["probability_type"]
 
 def extend_lead_skill(self, d):
-    d["explain_en"] = starlight.en.describe_lead_skill(objproxy(d))
+    d["explain_en"] = d["description"]
     d["target_attribute"] = enums.lskill_target_attr(d["target_attribute"])
     d["target_param"] = enums.lskill_target_param(d["target_param"])
     d["target_attribute_2"] = enums.lskill_target_attr(d["target_attribute_2"])
@@ -172,7 +221,8 @@ EXTEND_FUNC = {"skill_data_t": extend_skill,
                "card_data_t": extend_card,
                "chara_data_t": extend_char}
 KEY_BLACKLIST = {
-    "skill_data_t": ["chance", "dur"]
+    "skill_data_t": ["chance", "dur", "description", "description_html"],
+    "leader_skill_data_t": ["description", "description_html"],
 }
 
 class APIUtilMixin(object):
@@ -346,7 +396,7 @@ class ObjectAPI(CORSBlessMixin, HandlerSyncedWithMaster, APIUtilMixin):
             json.dump({"result": h(ids, cfg)}, self, ensure_ascii=0)
 
 @route(r"/api/v1/list/card_t")
-class CardListAPI(CORSBlessMixin, HandlerSyncedWithMaster, APIUtilMixin):
+class CardListAPI(CORSBlessMixin, ResponseCacheMixin, HandlerSyncedWithMaster, APIUtilMixin):
     KEYS = ["id", "chara_id", "attribute", "has_spread", "pose", "title", "name_only",
         "hp_min", "hp_max", "vocal_min", "vocal_max", "visual_min", "visual_max",
         "dance_min", "dance_max", "bonus_hp", "bonus_dance", "bonus_vocal", "bonus_visual",
@@ -399,6 +449,12 @@ class CardListAPI(CORSBlessMixin, HandlerSyncedWithMaster, APIUtilMixin):
         hasher.update(self.settings["instance_random"])
         return "\"{0}\"".format(hasher.hexdigest())
 
+    def response_cache_key(self):
+        ks_raw = self.get_argument("keys", "")
+        normalized = set(x.lower().strip() for x in ks_raw.split(","))
+        # Unknown keys don't change the output, as long as some were asked for.
+        return (bool(ks_raw), tuple(k for k in self.KEYS + self.STRUCTS if k in normalized))
+
     def get(self):
         self.set_cors_policy()
         self.set_etag_header()
@@ -407,6 +463,9 @@ class CardListAPI(CORSBlessMixin, HandlerSyncedWithMaster, APIUtilMixin):
             self.set_status(304)
             return
 
+        if self.serve_cached_response():
+            return
+
         ks_raw = self.get_argument("keys", "")
         if ks_raw:
             normalized = (x.lower().strip() for x in ks_raw.split(","))
@@ -461,15 +520,29 @@ class HappeningAPI(CORSBlessMixin, HandlerSyncedWithMaster, APIUtilMixin):
             timespec = datetime.utcfromtimestamp(timespec)
         timespec = pytz.utc.localize(timespec)
 
+        # ?until=<unix> turns this into a range query over [timespec, until).
+        until = self.get_argument("until", None)
+        if until is not None:
+            try:
+                until = pytz.utc.localize(datetime.utcfromtimestamp(int(until)))
+            except ValueError as e:
+                self.set_status(400)
+                self.write({"error": str(e)})
+                return
+
         cfg = {
             "stubs": self.get_argument("stubs", "no"),
             "datetime": self.get_argument("datetime", "unix")
         }
 
         self.set_header("Content-Type", "application/json; charset=utf-8")
-        payload = self.fix_namedtuples("",
-            {"events": starlight.data.events(timespec),
-             "gachas": starlight.data.gachas(timespec)}, cfg)
+        if until is None:
+            happening = {"events": starlight.data.events(timespec),
+                         "gachas": starlight.data.gachas(timespec)}
+        else:
+            happening = {"events": starlight.data.events_between(timespec, until),
+                         "gachas": starlight.data.gachas_between(timespec, until)}
+        payload = self.fix_namedtuples("", happening, cfg)
         if self.settings["is_dev"]:
             json.dump(payload, self, ensure_ascii=0, sort_keys=1, indent=2, default=self.fix_datetime)
         else:
@@ -5,6 +5,7 @@ import tornado.httpserver
 import tornado.ioloop
 import tornado.web
 import os
+import signal
 import tornado.options
 import json
 import ipaddress
@@ -21,6 +22,8 @@ import enums
 import starlight
 import analytics
 import webutil
+import frontpage
+import tlinline
 from starlight import private_data_path
 
 def early_init():
@@ -66,12 +69,17 @@ def early_init():
         _super_RequestHandler_prepare3(self)
     tornado.web.RequestHandler.prepare = _swizzle_RequestHandler_prepare3
 
+    if tlinline.TL_INLINE:
+        tlinline.install()
+
 def main():
     starlight.init()
     early_init()
     in_dev_mode = os.environ.get("DEV")
     image_server = os.environ.get("IMAGE_HOST", "")
     tornado.options.parse_command_line()
+    tle = models.TranslationEngine(starlight)
+    tle.check_schema()
     application = tornado.web.Application(dispatch.ROUTES,
         template_path="webui",
         static_path="static",
@@ -79,7 +87,8 @@ def main():
         debug=in_dev_mode,
         is_dev=in_dev_mode,
 
-        tle=models.TranslationEngine(starlight),
+        tle=tle,
+        home=frontpage.HomeSnapshot(tle),
         enums=enums,
         starlight=starlight,
         tlable=webutil.tlable,
@@ -93,11 +102,21 @@ def main():
     port = int(os.environ.get("PORT", 5000))
 
     http_server.listen(port, addr)
+    tornado.ioloop.IOLoop.current().add_callback(application.settings["home"].refresh)
+    tornado.ioloop.IOLoop.current().add_callback(tle.replica.sync)
+    tornado.ioloop.IOLoop.current().add_callback(tle.dump.refresh)
     print("Current APP_VER:", os.environ.get("VC_APP_VER",
         "1.9.1 (warning: Truth updates will fail in the future if an accurate VC_APP_VER "
         "is not set. Export VC_APP_VER to suppress this warning.)"))
     print("Ready.")
-    tornado.ioloop.IOLoop.current().start()
+
+    # Let queued translation submissions hit the database before we go.
+    loop = tornado.ioloop.IOLoop.current()
+    signal.signal(signal.SIGTERM, lambda *_: loop.add_callback_from_signal(loop.stop))
+    try:
+        loop.start()
+    finally:
+        tle.writer.drain()
 
 if __name__ == "__main__":
     main()
@@ -1,8 +1,11 @@
 import tornado.web
 import json
 import os
+import gzip
 import starlight
 import time
+import tlinline
+from collections import namedtuple
 try:
     from plop.collector import Collector, PlopFormatter
 except ImportError:
@@ -10,6 +13,8 @@ except ImportError:
 
 ROUTES = []
 
+cached_response_t = namedtuple("cached_response_t", ("headers", "body", "gzipped", "splice"))
+
 def conditional_route(yes, reason, *regexes):
     if yes:
         return route(*regexes)
@@ -55,6 +60,9 @@ def dev_mode_only(wrapped):
 
 class HandlerSyncedWithMaster(tornado.web.RequestHandler):
     def prepare(self):
+        # Keep the version this request started on open until it finishes,
+        # even if a newer one is published in the meantime.
+        self.data = starlight.data.pin()
         starlight.data.reset_statistics()
         self.did_trigger_update = starlight.update.check_version()
 
@@ -72,3 +80,73 @@ class HandlerSyncedWithMaster(tornado.web.RequestHandler):
             formatter = PlopFormatter(max_stacks=9001)
             if self.collector.samples_taken:
                 formatter.store(self.collector, "{0}_{1}.profile".format(self.__class__.__name__, time.time()))
+
+    def on_finish(self):
+        data = getattr(self, "data", None)
+        if data is not None:
+            self.data = None
+            data.unpin()
+
+        super().on_finish()
+
+
+class ResponseCacheMixin(object):
+    """For handlers whose output only depends on the truth version and a few
+       arguments. The first response for each key is kept (with a gzipped
+       copy) on the DataCache the request was pinned to, and replayed after
+       that. Use together with HandlerSyncedWithMaster."""
+
+    # Replayed along with the body.
+    CACHED_HEADERS = ("Content-Type", "Cache-Control", "Access-Control-Allow-Origin")
+
+    def response_cache_key(self):
+        """Return everything besides the version that the output depends on."""
+        raise NotImplementedError()
+
+    def serve_cached_response(self):
+        """Writes the cached response and returns True if there is one.
+           Otherwise, arranges for the response about to be rendered (or
+           streamed) to be cached and returns False."""
+        key = (self.__class__.__name__,) + tuple(self.response_cache_key())
+        cached = self.data.responses.get(key)
+        self.set_header("Vary", "Accept-Encoding")
+
+        if cached is None:
+            if not self.data.responses.budget:
+                return False
+            self.response_cache_pending = key
+            self.response_cache_parts = []
+            return False
+
+        for k, v in cached.headers:
+            self.set_header(k, v)
+
+        if "gzip" in self.request.headers.get("Accept-Encoding", ""):
+            self.set_header("Content-Encoding", "gzip")
+            self.write(tlinline.cached_gzip(self, cached))
+        else:
+            self.write(cached.body)
+        return True
+
+    def flush(self, *args, **kw):
+        # Streamed responses are put back together in finish.
+        if getattr(self, "response_cache_pending", None) is not None:
+            self.response_cache_parts.extend(self._write_buffer)
+        return super().flush(*args, **kw)
+
+    def finish(self, chunk=None):
+        key = getattr(self, "response_cache_pending", None)
+        if key is not None and self.get_status() == 200:
+            if chunk is not None:
+                self.write(chunk)
+                chunk = None
+
+            body = b"".join(self.response_cache_parts + self._write_buffer)
+            headers = tuple((k, self._headers[k]) for k in self.CACHED_HEADERS if k in self._headers)
+            if tlinline.TL_INLINE:
+                gzipped, splice = tlinline.spliceable_gzip(body)
+            else:
+                gzipped, splice = gzip.compress(body), None
+            self.data.responses.put(key, cached_response_t(headers, body, gzipped, splice))
+
+        return super().finish(chunk)
@@ -1,6 +1,7 @@
 import tornado.web
 import tornado.template
 import tornado.escape
+import tornado.iostream
 from dispatch import *
 import os
 import json
@@ -11,11 +12,12 @@ import itertools
 import enums
 import table
 import hashlib
-from models import extra
-from collections import defaultdict
 from datetime import datetime, timedelta
+from functools import partial
 
 import webutil
+import frontpage
+import tlinline
 
 @route(r"/([0-9]+-[0-9]+-[0-9]+)?")
 class Home(HandlerSyncedWithMaster):
@@ -23,72 +25,58 @@ class Home(HandlerSyncedWithMaster):
         return self.get(pretend_date)
 
     async def get(self, pretend_date):
-        actually_now = pytz.utc.localize(datetime.utcnow())
+        model = await self.settings["home"].get()
+        if model is None:
+            raise tornado.web.HTTPError(503)
 
+        birthdays = model.birthdays
         if pretend_date:
             now = pytz.utc.localize(datetime.strptime(pretend_date, "%Y-%m-%d"))
-        else:
-            now = actually_now
-
-        if now.day == 29 and now.month == 2:
-            now += timedelta(days=1)
-
-        # Show only cu/co/pa chara birthdays. Chihiro is a minefield and causes
-        # problems
-        birthdays = list(filter(lambda char: 0 < char.type < 4,
-                         starlight.data.potential_birthdays(now)))
+            birthdays = await frontpage.birthdays_at(frontpage.birthday_now(now), self.data)
 
-        recent_history = self.settings["tle"].get_history(10)
-        
-        # cache priming has a high overhead so prime all icons at once
-        preprime_set = set()
-        for h in recent_history:
-            preprime_set.update(h.card_list())
-        starlight.data.cards(preprime_set)
-        
-        # Now split the events into current/past.
-        now_utime = actually_now.timestamp()
-        current_events = [event for event in recent_history 
-            if now_utime >= event.start_time and now_utime < event.end_time]
-        # Always put events first like the old box list.
-        current_events.sort(key=lambda event: -1 if event.type() == extra.HISTORY_TYPE_EVENT else 1)
-    
-        rates = {}
-        for event in current_events:
-            recent_history.remove(event)
-
-            if event.type() == extra.HISTORY_TYPE_GACHA:
-                rate = await starlight.data.live_gacha_rates(event.referred_id())
-                if not rate:
-                    continue
-
-                try:
-                    rates[rate["gacha"]] = rate["rates"]
-                except KeyError:
-                    continue
-
-        self.render("main.html", history=recent_history,
-            current_history=current_events,
-            live_gacha_rates=rates,
+        self.render("main.html", history=model.history,
+            current_history=model.current_history,
+            live_gacha_rates=model.live_gacha_rates,
             birthdays=birthdays, **self.settings)
         self.settings["analytics"].analyze_request(self.request, self.__class__.__name__)
 
 @route("/suggest")
 class SuggestNames(HandlerSyncedWithMaster):
+    # Without ?q=, the whole key -> [name, chara_id] map for the client-side
+    # fuzzy finder. With it, the best k matches, searched on our side.
+    MAX_RESULTS = 50
+
+    def compute_etag(self):
+        hasher = hashlib.sha1(b"SuggestNames version ")
+        hasher.update(self.settings["instance_random"])
+        hasher.update(str(starlight.data.version).encode("utf8"))
+        hasher.update("; q={0}; k={1}".format(
+            self.get_argument("q", None), self.get_argument("k", None)).encode("utf8"))
+        return "\"{0}\"".format(hasher.hexdigest())
+
     def get(self):
-        names = {value.conventional.lower(): [value.kanji, key] for key, value in starlight.data.names.items()}#conventional value.conventional
-        names.update({str(key): [value.kanji, key] for key, value in starlight.data.names.items()})#chara_id
-        
-        # additional keyword set
-        names.update({str(value.kana_spaced): [value.kanji, key] for key, value in starlight.data.names.items()})#kana_spaced
-        names.update({str(value.kanji): [value.kanji, key] for key, value in starlight.data.names.items()})#kanji
-        names.update({str(value.translated): [value.translated + " *" , key] for key, value in starlight.data.names.items()})#translated
-        names.update({str(value.translated_cht): [value.translated_cht + " *", key] for key, value in starlight.data.names.items()})#translated_cht
-		
-        self.set_header("Content-Type", "application/json")
+        index = starlight.data.suggest_index
+        query = self.get_argument("q", None)
+
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
         self.set_header("Cache-Control", "no-cache")
         self.set_header("Expires", "0")
-        self.write(names)
+
+        if query is None:
+            self.set_etag_header()
+            if self.check_etag_header():
+                self.set_status(304)
+                return
+            self.write(index.completion_json)
+            return
+
+        try:
+            limit = min(max(int(self.get_argument("k", "10")), 1), self.MAX_RESULTS)
+        except ValueError:
+            limit = 10
+
+        self.write(tornado.escape.json_encode([{"name": name, "chara_id": chara_id, "key": key}
+            for name, chara_id, key in index.search(query, limit)]))
 
 @route(r"/_evt")
 class EventD(HandlerSyncedWithMaster):
@@ -110,7 +98,7 @@ class EventD(HandlerSyncedWithMaster):
 
 @route(r"/char/([0-9]+)(/table)?")
 class Character(HandlerSyncedWithMaster):
-    def get(self, chara_id, use_table):
+    async def get(self, chara_id, use_table):
         chara_id = int(chara_id)
         achar = starlight.data.chara(chara_id)
 
@@ -122,19 +110,7 @@ class Character(HandlerSyncedWithMaster):
                 unique.append(c)
 
         acard = [starlight.data.cards(ch) for ch in unique]
-        eventset = {x.id: x for x in starlight.data.event_ids()}
-
-        availability = defaultdict(lambda: [])
-        av_dict_from_tle = self.settings["tle"].lookup_event_cards(card_ids)
-        for cid, events in av_dict_from_tle.items():
-            for eid in events:
-                x = eventset[eid]
-                avs = starlight.Availability(starlight.Availability._TYPE_EVENT, x.name, x.start_date, x.end_date)
-                availability[cid].append(avs)
-
-        ga_av = self.settings["tle"].gacha_availability(card_ids, starlight.data.gacha_ids())
-        for k in ga_av:
-            availability[k].extend(ga_av[k])
+        availability = await self.settings["tle"].async_availability(card_ids)
 
         if achar:
             self.set_header("Content-Type", "text/html")
@@ -155,7 +131,7 @@ class Character(HandlerSyncedWithMaster):
 
 @route(r"/card/([0-9\,]+)(/table)?")
 class Card(HandlerSyncedWithMaster):
-    def get(self, card_idlist, use_table):
+    async def get(self, card_idlist, use_table):
         card_ids = [int(x) for x in card_idlist.strip(",").split(",")]
 
         chains = [starlight.data.chain(id) for id in card_ids]
@@ -165,20 +141,7 @@ class Card(HandlerSyncedWithMaster):
                 unique.append(c)
 
         acard = [starlight.data.cards(ch) for ch in unique if ch]
-
-        eventset = {x.id: x for x in starlight.data.event_ids()}
-
-        availability = defaultdict(lambda: [])
-        av_dict_from_tle = self.settings["tle"].lookup_event_cards(card_ids)
-        for cid, events in av_dict_from_tle.items():
-            for eid in events:
-                x = eventset[eid]
-                avs = starlight.Availability(starlight.Availability._TYPE_EVENT, x.name, x.start_date, x.end_date)
-                availability[cid].append(avs)
-
-        ga_av = self.settings["tle"].gacha_availability(card_ids, starlight.data.gacha_ids())
-        for k in ga_av:
-            availability[k].extend(ga_av[k])
+        availability = await self.settings["tle"].async_availability(card_ids)
 
         if acard:
             if len(acard) == 1:
@@ -206,11 +169,12 @@ class ShortlinkTable(HandlerSyncedWithMaster):
     # This shouldn't take too long.
     # The full chain is pre-emptively loaded when any member is requested
     def flip_chain(self, card):
-        return starlight.data.card(starlight.data.chain(card.series_id)[-1])
+        return self.data.card(self.data.chain(card.series_id)[-1])
 
-    def rendertable(self, dataset, cards,
-                    allow_shortlink=1, table_name="自定义列表",
-                    template="generictable.html", **extra):
+    # Rows per flush in streamtable.
+    STREAM_CHUNK_ROWS = 200
+
+    def table_args(self, dataset, cards, allow_shortlink, table_name, extra):
         if isinstance(dataset, str):
             filters, categories = table.select_categories(dataset)
         else:
@@ -218,20 +182,60 @@ class ShortlinkTable(HandlerSyncedWithMaster):
 
         should_switch_chain_head = self.get_argument("plus", "NO") == "YES"
         if should_switch_chain_head:
-            cards = list(map(self.flip_chain, cards))
+            cards = map(self.flip_chain, cards)
+        if allow_shortlink:
+            # The shortlink needs every card before the rows are written.
+            cards = list(cards)
 
         extra.update(self.settings)
 
-        self.render(template,
-                    filters=filters,
+        return dict(filters=filters,
                     categories=categories,
                     cards=cards,
                     original_dataset=dataset,
                     show_shortlink=allow_shortlink,
                     table_name=table_name,
                     is_displaying_awake_forms=should_switch_chain_head,
+                    render_row=partial(table.render_row, data=self.data),
+                    stream_marker=None,
                     **extra)
 
+    def rendertable(self, dataset, cards,
+                    allow_shortlink=1, table_name="自定义列表",
+                    template="generictable.html", **extra):
+        self.render(template, **self.table_args(dataset, cards, allow_shortlink, table_name, extra))
+
+    async def streamtable(self, dataset, cards,
+                          allow_shortlink=1, table_name="自定义列表",
+                          template="generictable.html", **extra):
+        """Like rendertable, but the page around the rows is sent right away
+           and the rows follow in chunks, so a big table never has to
+           exist as one string."""
+        args = self.table_args(dataset, cards, allow_shortlink, table_name, extra)
+        args["stream_marker"] = table.STREAM_MARKER
+        head, tail = self.render_string(template, **args).split(table.STREAM_MARKER.encode("utf8"), 1)
+
+        self.write(head)
+        await self.flush()
+
+        filters, categories = args["filters"], args["categories"]
+        chunk = []
+        try:
+            for card in args["cards"]:
+                chunk.append(table.render_row(filters, categories, card, self.data))
+                if len(chunk) >= self.STREAM_CHUNK_ROWS:
+                    self.write("".join(chunk))
+                    chunk = []
+                    await self.flush()
+        except tornado.iostream.StreamClosedError:
+            # The client went away; stop rendering, and don't let
+            # ResponseCacheMixin keep the half we got through.
+            self.response_cache_pending = None
+            return
+
+        self.write("".join(chunk))
+        self.finish(tail)
+
     def get(self, dataset, spec):
         try:
             idlist = webutil.decode_cardlist(spec)
@@ -244,49 +248,59 @@ class ShortlinkTable(HandlerSyncedWithMaster):
         self.settings["analytics"].analyze_request(self.request, self.__class__.__name__)
 
 @route(r"/skill_table")
-class SkillTable(ShortlinkTable):
+class SkillTable(ResponseCacheMixin, ShortlinkTable):
     def compute_etag(self):
         hasher = hashlib.sha1(b"SkillTable version ")
         hasher.update(self.settings["instance_random"])
-        hasher.update(str(starlight.data.version).encode("utf8"))
+        hasher.update(str(self.data.version).encode("utf8"))
         hasher.update("; plus={0}".format(
             "yes" if self.get_argument("plus", "NO") == "YES" else "no").encode("utf8"))
+        hasher.update(tlinline.etag_revision(self))
         return "\"{0}\"".format(hasher.hexdigest())
 
-    def get(self):
+    def response_cache_key(self):
+        return (self.get_argument("plus", "NO") == "YES",)
+
+    async def get(self):
         self.set_etag_header()
         if self.check_etag_header():
             self.set_status(304)
             return
 
         self.set_header("Cache-Control", "must-revalidate")
-        ds = filter(lambda C: C.skill is not None, starlight.data.cards(starlight.data.all_chain_ids()))
-        self.rendertable("CASDE", ds,
-            allow_shortlink=0,
-            table_name="Cards by skill")
+        if not self.serve_cached_response():
+            ds = filter(lambda C: C.skill is not None, self.data.cards(self.data.all_chain_ids()))
+            await self.streamtable("CASDE", ds,
+                allow_shortlink=0,
+                table_name="Cards by skill")
         self.settings["analytics"].analyze_request(self.request, self.__class__.__name__)
 
 @route(r"/lead_skill_table")
-class LeadSkillTable(ShortlinkTable):
+class LeadSkillTable(ResponseCacheMixin, ShortlinkTable):
     def compute_etag(self):
         hasher = hashlib.sha1(b"LeadSkillTable version ")
         hasher.update(self.settings["instance_random"])
-        hasher.update(str(starlight.data.version).encode("utf8"))
+        hasher.update(str(self.data.version).encode("utf8"))
         hasher.update("; plus={0}".format(
             "yes" if self.get_argument("plus", "NO") == "YES" else "no").encode("utf8"))
+        hasher.update(tlinline.etag_revision(self))
         return "\"{0}\"".format(hasher.hexdigest())
 
-    def get(self):
+    def response_cache_key(self):
+        return (self.get_argument("plus", "NO") == "YES",)
+
+    async def get(self):
         self.set_etag_header()
         if self.check_etag_header():
             self.set_status(304)
             return
 
         self.set_header("Cache-Control", "must-revalidate")
-        ds = filter(lambda C: C.lead_skill is not None, starlight.data.cards(starlight.data.all_chain_ids()))
-        self.rendertable("CAKL", ds,
-            allow_shortlink=0,
-            table_name="Cards by lead skill")
+        if not self.serve_cached_response():
+            ds = filter(lambda C: C.lead_skill is not None, self.data.cards(self.data.all_chain_ids()))
+            await self.streamtable("CAKL", ds,
+                allow_shortlink=0,
+                table_name="Cards by lead skill")
         self.settings["analytics"].analyze_request(self.request, self.__class__.__name__)
 
 @route(r"/table/([A-Za-z]+)/([0-9\,]+)")
@@ -313,7 +327,7 @@ class CompareCard(ShortlinkTable):
 @route(r"/gacha(?:/([0-9]+))?")
 class GachaTable(ShortlinkTable):
     def awakened_id(self, cid):
-        return starlight.data.chain(cid)[-1]
+        return self.data.chain(cid)[-1]
 
     async def get(self, maybe_gachaid):
         now = pytz.utc.localize(datetime.utcnow())
@@ -351,9 +365,9 @@ class GachaTable(ShortlinkTable):
             return 
         
         want_awakened = self.get_argument("plus", "NO") == "YES"
-        live_info = await starlight.data.live_gacha_rates(selected_gacha.id)
+        live_info = await self.data.live_gacha_rates(selected_gacha.id)
 
-        availability_list = starlight.data.available_cards(selected_gacha)
+        availability_list = await self.data.async_available_cards(selected_gacha)
         availability_list.sort(key=lambda x: x.sort_order)
 
         want_id_list = [gr.card_id for gr in availability_list]
@@ -365,7 +379,7 @@ class GachaTable(ShortlinkTable):
         if live_info:
             want_id_list.extend(cid for cid in live_info["indiv"] if cid not in limited_flags)
 
-        card_list = starlight.data.cards(want_id_list)
+        card_list = self.data.cards(want_id_list)
 
         filters, categories = table.select_categories("CASDE")
 
@@ -409,19 +423,30 @@ class MiniTable(ShortlinkTable):
                     **extra)
 
 @route(r"/motif_internal/([1-9][0-9]*)")
-class MotifInternalTable(MiniTable):
-    def get(self, type):
+class MotifInternalTable(ResponseCacheMixin, MiniTable):
+    def appeal_class(self):
+        css_class = self.get_argument("appeal", "vocal")
+        if css_class not in {"vocal", "visual", "dance"}:
+            css_class = "vocal"
+        return css_class
+
+    def response_cache_key(self):
+        return (int(self.path_args[0]), self.appeal_class())
+
+    async def get(self, type):
+        if self.serve_cached_response():
+            self.settings["analytics"].analyze_request(self.request, self.__class__.__name__)
+            return
+
         t = int(type)
         try:
-            dataset = starlight.data.fetch_motif_data(t)
+            dataset = await self.data.async_fetch_motif_data(t)
         except ValueError:
             self.set_status(404)
             self.write("This table doesn't currently exist.")
             return
 
-        css_class = self.get_argument("appeal", "vocal")
-        if css_class not in {"vocal", "visual", "dance"}:
-            css_class = "vocal"
+        css_class = self.appeal_class()
 
         motif_cats = [table.IndexedCustomNumber(0, "Appeal value", dclass=css_class),
             table.IndexedCustomNumber(1, "Score bonus", format="+{0}%"),
@@ -431,11 +456,18 @@ class MotifInternalTable(MiniTable):
         self.settings["analytics"].analyze_request(self.request, self.__class__.__name__)
 
 @route(r"/sparkle_internal/([1-9][0-9]*)")
-class SparkleInternalTable(MiniTable):
-    def get(self, type):
+class SparkleInternalTable(ResponseCacheMixin, MiniTable):
+    def response_cache_key(self):
+        return (int(self.path_args[0]),)
+
+    async def get(self, type):
+        if self.serve_cached_response():
+            self.settings["analytics"].analyze_request(self.request, self.__class__.__name__)
+            return
+
         t = int(type)
         try:
-            dataset = starlight.data.fetch_sparkle_data(t)
+            dataset = await self.data.async_fetch_sparkle_data(t)
         except ValueError:
             self.set_status(404)
             self.write("This table doesn't currently exist.")
@@ -466,13 +498,13 @@ class SpriteRedirect(tornado.web.RequestHandler):
 
 @route(r"/sprite_go_ex/([0-9]+)")
 class SpriteViewerEX(tornado.web.RequestHandler):
-    def get(self, chara_id):
+    async def get(self, chara_id):
         # hack for footer text compat
         self.did_trigger_update = False
 
         achar = starlight.data.chara(int(chara_id))
         if achar:
-            svxdata = starlight.data.svx_data(achar.chara_id)
+            svxdata = await starlight.data.async_svx_data(achar.chara_id)
             self.render("spriteviewer.html",
                 load="{0}/chara2/{1}".format(self.settings["image_host"], int(chara_id)),
                 known_poses=svxdata,
@@ -486,14 +518,9 @@ class SpriteViewerEX(tornado.web.RequestHandler):
 @route(r"/history/([0-9]+)")
 class History(HandlerSyncedWithMaster):
     """ Display all history entries. """
-    def get(self, page=None):
+    async def get(self, page=None):
         page = max(int(page or 1), 1)
-        all_history = self.settings["tle"].get_history(nent=50, page=page - 1)
-
-        preprime_set = set()
-        for h in all_history:
-            preprime_set.update(h.card_list())
-        starlight.data.cards(preprime_set)
+        all_history = await self.settings["tle"].async_get_history(50, page - 1)
 
         self.render("history.html", history=all_history, page=page, **self.settings)
         self.settings["analytics"].analyze_request(self.request, self.__class__.__name__)
@@ -501,25 +528,28 @@ class History(HandlerSyncedWithMaster):
 @route(r"/tl_cacheall")
 @dev_mode_only
 class DebugTLCacheUpdate(tornado.web.RequestHandler):
-    def get(self):
-        self.settings["tle"].update_caches()
+    async def get(self):
+        await self.settings["tle"].async_update_caches(incremental=self.get_argument("incremental", None) == "1")
         self.write("ok.")
 
 @route(r"/ga_genpresencecache")
 @dev_mode_only
 class DebugGachaPresenceUpdate(tornado.web.RequestHandler):
-    def get(self):
-        cl = self.settings["tle"].gen_presence(starlight.data.gacha_ids())
+    async def get(self):
+        tle = self.settings["tle"]
+        cl = await tle.run_query(tle.gen_presence, starlight.data.gacha_ids())
+        tle.invalidate_availability()
         self.set_header("Content-Type", "text/plain; charset=utf-8")
         self.write("ok")
 
 @route(r"/tl_debug")
 @dev_mode_only
 class DebugViewTLs(tornado.web.RequestHandler):
-    def get(self):
+    async def get(self):
         #chara_id = int(chara_id)
+        tle = self.settings["tle"]
         gen = list((x.key, x.english, x.submitter, time.strftime("%c", time.gmtime(x.submit_utc)))
-            for x in filter(lambda x: x.key != x.english, self.settings["tle"].all()))
+            for x in filter(lambda x: x.key != x.english, await tle.run_query(tle.all)))
         fields = ("key", "english", "sender", "ts")
 
         self.set_header("Content-Type", "text/html")
@@ -529,10 +559,11 @@ class DebugViewTLs(tornado.web.RequestHandler):
 @route(r"/tl_debug/(.+)")
 @dev_mode_only
 class DebugViewTLExtreme(tornado.web.RequestHandler):
-    def get(self, key):
+    async def get(self, key):
         #chara_id = int(chara_id)
+        tle = self.settings["tle"]
         gen = list((x.key, x.english, x.submitter, time.strftime("%c", time.gmtime(x.submit_utc)))
-            for x in self.settings["tle"].all_for_key(key))
+            for x in await tle.run_query(tle.all_for_key, key))
         fields = ("key", "english", "sender", "ts")
 
         self.set_header("Content-Type", "text/html")
@@ -544,15 +575,44 @@ class DebugViewTLExtreme(tornado.web.RequestHandler):
 class DebugKillCache(tornado.web.RequestHandler):
     def get(self):
         self.settings["tle"].kill_caches(0)
-        starlight.data = starlight.DataCache(starlight.data.version)
+        starlight.publish_version(starlight.build_version(starlight.data.version, use_snapshot=0))
 
         self.write("ok.")
 
+@route(r"/cache_stats")
+@dev_mode_only
+class DebugCacheStats(tornado.web.RequestHandler):
+    def get(self):
+        tle = self.settings["tle"]
+        stats = {
+            "live_gacha_rates": starlight.data.live_cache["gacha"].stats,
+            "fragments": dict(starlight.data.fragments.stats,
+                entries=len(starlight.data.fragments), bytes=starlight.data.fragments.size),
+            "responses": dict(starlight.data.responses.stats,
+                entries=len(starlight.data.responses), bytes=starlight.data.responses.size),
+            "tlable_signatures": dict(webutil.tlable_signatures.stats,
+                table_entries=len(starlight.data.tlable_signatures),
+                adhoc=dict(webutil.tlable_signatures.adhoc.stats, entries=len(webutil.tlable_signatures.adhoc))),
+            "translations": dict(tle.replica.stats,
+                entries=len(tle.replica.entries or ()), max_id=tle.replica.max_id),
+            "translations_fallback": tle.replica.fallback.stats,
+            "translations_bloom": tle.replica.bloom and tle.replica.bloom.describe(),
+            "translation_writes": dict(tle.writer.stats, queued=len(tle.writer.queue)),
+            "translation_dump": dict(tle.dump.stats, deltas=len(tle.dump.deltas),
+                revision=tle.dump.snapshot and tle.dump.snapshot.revision,
+                bytes=tle.dump.snapshot and len(tle.dump.snapshot.body),
+                gzipped_bytes=tle.dump.snapshot and len(tle.dump.snapshot.gzipped)),
+        }
+
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.write(json.dumps(stats, sort_keys=1, indent=2))
+
 @route(r"/sync_event_lookup")
 @dev_mode_only
 class DebugSyncEventLookup(tornado.web.RequestHandler):
     def get(self):
         self.settings["tle"].sync_event_lookup_table()
+        self.settings["tle"].invalidate_availability()
         self.write("ok.")
 
 @route(r"/test_gacha_rate")
@@ -574,7 +634,7 @@ class Ping(tornado.web.RequestHandler):
         self.write("{} {} {} {} {}".format(
             starlight.data.version,
             starlight.last_version_check,
-            len(starlight.data.card_cache),
-            len(starlight.data.char_cache),
+            len(starlight.data.card_store),
+            len(starlight.data.char_store),
             "It's working"
         ))
@@ -0,0 +1,121 @@
+import os
+import asyncio
+from datetime import datetime, timedelta
+from collections import namedtuple
+import pytz
+from tornado import ioloop
+
+import starlight
+from models import extra
+
+# Everything the home page shows, apart from the chrome. It's rebuilt every
+# HOME_REFRESH_INTERVAL seconds, as soon as something in it starts or ends,
+# and whenever a new truth version is published, so requests never wait
+# on the translation DB or the game API (except the very first one).
+
+HOME_REFRESH_INTERVAL = int(os.getenv("HOME_REFRESH_INTERVAL", "60"))
+
+home_model_t = namedtuple("home_model_t", ("version", "built_at",
+    "history", "current_history", "live_gacha_rates", "birthdays"))
+
+def birthday_now(now=None):
+    now = now or pytz.utc.localize(datetime.utcnow())
+    if now.day == 29 and now.month == 2:
+        now += timedelta(days=1)
+    return now
+
+async def birthdays_at(now, data=None):
+    # Show only cu/co/pa chara birthdays. Chihiro is a minefield and causes
+    # problems
+    return list(filter(lambda char: 0 < char.type < 4,
+                       await (data or starlight.data).async_potential_birthdays(now)))
+
+class HomeSnapshot(object):
+    def __init__(self, tle, interval=HOME_REFRESH_INTERVAL):
+        self.tle = tle
+        self.interval = interval
+        self.model = None
+        self.building = None
+        self.next_refresh = None
+        starlight.version_listeners.append(self.version_published)
+
+    async def get(self):
+        if self.model is None or self.model.version != starlight.data.version:
+            building = self.refresh()
+            if self.model is None:
+                await building
+        return self.model
+
+    def version_published(self, new_data):
+        ioloop.IOLoop.current().add_callback(self.refresh)
+
+    def refresh(self):
+        """Starts a rebuild unless one is already running, and returns it."""
+        if self.building is None:
+            self.building = asyncio.ensure_future(self.build())
+        return self.building
+
+    async def build(self):
+        loop = ioloop.IOLoop.current()
+        try:
+            self.model = await self.build_model()
+        except Exception as e:
+            print("HomeSnapshot: refresh failed ({0!r}), keeping the old one".format(e))
+        finally:
+            self.building = None
+
+        if self.next_refresh is not None:
+            loop.remove_timeout(self.next_refresh)
+        self.next_refresh = loop.call_later(self.seconds_until_stale(), self.refresh)
+
+    def seconds_until_stale(self):
+        delay = self.interval
+        if self.model is None:
+            return delay
+
+        now = self.model.built_at
+        for event in self.model.current_history + self.model.history:
+            for edge in (event.start_time, event.end_time):
+                if edge > now:
+                    delay = min(delay, edge - now + 1)
+        return delay
+
+    async def build_model(self):
+        # Everything comes from one version, kept open until we're done.
+        data = starlight.data.pin()
+        try:
+            return await self.build_model_from(data)
+        finally:
+            data.unpin()
+
+    async def build_model_from(self, data):
+        actually_now = pytz.utc.localize(datetime.utcnow())
+        version = data.version
+        birthdays = await birthdays_at(birthday_now(actually_now), data)
+
+        history = await self.tle.async_get_history(10)
+        if history is None:
+            raise ValueError("get_history failed")
+
+        # Now split the events into current/past.
+        now_utime = actually_now.timestamp()
+        current_events = [event for event in history
+            if now_utime >= event.start_time and now_utime < event.end_time]
+        # Always put events first like the old box list.
+        current_events.sort(key=lambda event: -1 if event.type() == extra.HISTORY_TYPE_EVENT else 1)
+
+        rates = {}
+        for event in current_events:
+            history.remove(event)
+
+            if event.type() == extra.HISTORY_TYPE_GACHA:
+                rate = await data.live_gacha_rates(event.referred_id())
+                if not rate:
+                    continue
+
+                try:
+                    rates[rate["gacha"]] = rate["rates"]
+                except KeyError:
+                    continue
+
+        return home_model_t(version, now_utime, history, current_events, rates, birthdays)
@@ -1,5 +1,7 @@
 import os
 import json
+import asyncio
+import threading
 from pytz import utc
 from datetime import datetime
 import time
@@ -7,11 +9,27 @@ from sqlalchemy.exc import OperationalError, ProgrammingError
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, aliased, load_only
-from sqlalchemy import func
+from sqlalchemy import func, inspect
 from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from tornado.ioloop import IOLoop
 
 from .base import *
 from .extra import *
+from .replica import TranslationReplica
+from .writebehind import TranslationWriteBehind
+from .dump import TranslationDump
+
+# The translation DB may be remote, so handlers never talk to it on the
+# IOLoop: the async_* methods run the blocking ones on this pool instead.
+# A call that takes longer than TLE_DB_TIMEOUT raises asyncio.TimeoutError
+# in the handler (the worker thread itself can't be interrupted).
+TLE_DB_TIMEOUT = float(os.getenv("TLE_DB_TIMEOUT", "10"))
+# Seconds before a failed availability index build is tried again.
+AVAILABILITY_RETRY_INTERVAL = 30
+db_pool = ThreadPoolExecutor(max_workers=int(os.getenv("TLE_DB_THREADS", "4")),
+    thread_name_prefix="tle-db")
 
 def int_time():
     return int(time.time())
@@ -30,50 +48,117 @@ def retry(n):
 class TranslationSQL(object):
     def __init__(self, override_url=None):
         self.really_connected = 0
-        self.session_nest = []
+        self.connect_lock = threading.Lock()
+        # Sessions can't be shared between threads, so each one nests its own.
+        self.local = threading.local()
         self.connect_url = override_url
+        # Only backfill_key_hash.py, which adds it, works without key_hash.
+        self.require_key_hash = 1
 
         self.availability_cache = {}
+        # highest entry id update_caches has seen, for incremental runs
+        self.caches_built_to = None
         self.caches_disabled = bool(os.getenv("TLE_DISABLE_CACHES"))
         if self.caches_disabled:
             print("TranslationSQL: no caching")
 
     def __enter__(self):
-        if not self.really_connected:
-            conn_s = self.connect_url or os.getenv("DATABASE_CONNECT")
-            self.engine = create_engine(conn_s, echo=False,
-                #connect_args={"ssl": {"dummy": "yes"}})
-		connect_args={'sslmode':'require'})
+        with self.connect_lock:
+            if not self.really_connected:
+                conn_s = self.connect_url or os.getenv("DATABASE_CONNECT")
+                self.engine = create_engine(conn_s, echo=False,
+                    #connect_args={"ssl": {"dummy": "yes"}})
+		    connect_args={'sslmode':'require'})
 
-            try:
-                Base.metadata.create_all(self.engine)
-            except (TypeError, ProgrammingError):
-                self.engine = create_engine(conn_s, echo=False)
-                Base.metadata.create_all(self.engine)
-
-            self.Session = sessionmaker(self.engine)
-            self.really_connected = 1
+                try:
+                    Base.metadata.create_all(self.engine)
+                except (TypeError, ProgrammingError):
+                    self.engine = create_engine(conn_s, echo=False)
+                    Base.metadata.create_all(self.engine)
+
+                # create_all doesn't add columns to tables that already exist,
+                # and every lookup and write goes through key_hash, so there's
+                # no point carrying on without it.
+                for table in (TranslationEntry, TranslationCache) if self.require_key_hash else ():
+                    columns = {c["name"] for c in inspect(self.engine).get_columns(table.__tablename__)}
+                    if "key_hash" not in columns:
+                        raise RuntimeError("TranslationSQL: {0} has no key_hash column. "
+                            "Run toolchain/backfill_key_hash.py first.".format(table.__tablename__))
+
+                self.Session = sessionmaker(self.engine)
+                self.really_connected = 1
 
         self.session_nest.append(self.Session())
         return self.session_nest[-1]
 
+    def check_schema(self):
+        """Raises RuntimeError unless every translation row has its key_hash,
+           so the app refuses to start on tables backfill_key_hash.py hasn't
+           finished with (their rows would never be found)."""
+        with self as s:
+            for table in (TranslationEntry, TranslationCache):
+                if s.query(table.id).filter(table.key_hash == None).first() is not None:
+                    raise RuntimeError("TranslationSQL: {0} has rows without a key_hash. "
+                        "Run toolchain/backfill_key_hash.py first.".format(table.__tablename__))
+
     def __exit__(self, exc_type, exc_value, traceback):
         if exc_value:
             self.session_nest[-1].rollback()
         self.session_nest[-1].close()
         self.session_nest.pop()
 
+    @property
+    def session_nest(self):
+        nest = getattr(self.local, "nest", None)
+        if nest is None:
+            nest = self.local.nest = []
+        return nest
+
+    def run_query(self, func, *args):
+        """Runs func(*args) on the DB pool. Returns an awaitable that gives
+           up after TLE_DB_TIMEOUT seconds."""
+        return asyncio.wait_for(self.run_query_to_end(func, *args), TLE_DB_TIMEOUT)
+
+    def run_query_to_end(self, func, *args):
+        """run_query without the timeout, for when what happened matters
+           more than how long it took."""
+        return IOLoop.current().run_in_executor(db_pool, partial(func, *args))
+
+    def latest_entries(self, s, hashes=None, *columns):
+        """The newest entry of every key (or just of the keys with one of
+           hashes, which can be a query of key_hash). Ties on submit_utc go
+           to the higher id.
+           This is one pass over the history, keeping the best row per key,
+           so it's linear whatever the database's planner does with it.
+           With columns, gives tuples of just those straight from that pass.
+           Without, the winners are then loaded as TranslationEntry by id."""
+        q = s.query(TranslationEntry.key.label("rank_key"), TranslationEntry.submit_utc.label("rank_utc"),
+            TranslationEntry.id.label("rank_id"), *columns)
+        if hashes is not None:
+            q = q.filter(TranslationEntry.key_hash.in_(hashes))
+
+        best = {}
+        # Core rows: building ORM result tuples would double the time here.
+        for row in s.execute(q.statement):
+            rank = (row[1] or 0, row[2])
+            held = best.get(row[0])
+            if held is None or held[0] <= rank:
+                best[row[0]] = (rank, tuple(row[3:]))
+
+        if columns:
+            return [values for _, values in best.values()]
+
+        ids = sorted(id for (_, id), _ in best.values())
+        result = []
+        for start in range(0, len(ids), 500):
+            result.extend(s.query(TranslationEntry).filter(
+                TranslationEntry.id.in_(ids[start:start + 500])))
+        return result
+
     @retry(5)
     def all(self):
         with self as s:
-            transient = aliased(TranslationEntry)
-            result = s.query(TranslationEntry).filter(
-                s.query(func.count(transient.id))
-                .filter(transient.submit_utc >= TranslationEntry.submit_utc)
-                .filter(transient.key == TranslationEntry.key)
-                .order_by(transient.id.desc())
-                .correlate(TranslationEntry)
-                .as_scalar() == 1).all()
+            result = self.latest_entries(s)
         return result
 
     @retry(5)
@@ -85,14 +170,20 @@ class TranslationSQL(object):
     @retry(5)
     def all_for_key(self, key):
         with self as s:
-            result = s.query(TranslationEntry).filter(TranslationEntry.key == key).order_by(TranslationEntry.submit_utc).all()
+            result = s.query(TranslationEntry).filter(TranslationEntry.key_hash == key_hash(key),
+                TranslationEntry.key == key).order_by(TranslationEntry.submit_utc).all()
         return result
 
-    @retry(5)
     def translate(self, done, *key):
+        done(self.translations(key) or [])
+
+    @retry(5)
+    def translations(self, keys):
         with self as s:
-            result = s.query(TranslationCache).filter(TranslationCache.key.in_(key)).limit(len(key)).all()
-        done(result)
+            rows = s.query(TranslationCache).filter(TranslationCache.key_hash.in_(
+                list({key_hash(key) for key in keys}))).all()
+        keys = set(keys)
+        return [row for row in rows if row.key in keys]
 
     @retry(5)
     def set_translation(self, key, eng, sender, force_time=None):
@@ -100,12 +191,59 @@ class TranslationSQL(object):
             s.add(TranslationEntry(key=key, english=eng,
                                    submitter=sender, submit_utc=force_time or int_time()))
             try:
-                thing_to_update = s.query(TranslationCache).filter(TranslationCache.key == key).one()
+                thing_to_update = s.query(TranslationCache).filter(TranslationCache.key_hash == key_hash(key),
+                    TranslationCache.key == key).one()
             except NoResultFound:
                 thing_to_update = TranslationCache(key=key, english=eng)
             thing_to_update.english = eng
             s.add(thing_to_update)
             s.commit()
+        return 1
+
+    @retry(5)
+    def set_translations(self, batch):
+        """Writes many submissions in one transaction.
+           batch is [(key, english, sender, submit_utc), ...], oldest first."""
+        latest = {}
+        for key, eng, _, _ in batch:
+            latest[key] = eng
+
+        with self as s:
+            s.add_all([TranslationEntry(key=key, english=eng, submitter=sender, submit_utc=ts)
+                for key, eng, sender, ts in batch])
+
+            found = set()
+            for thing_to_update in s.query(TranslationCache).filter(TranslationCache.key_hash.in_(
+                    list({key_hash(key) for key in latest}))):
+                if thing_to_update.key in latest:
+                    thing_to_update.english = latest[thing_to_update.key]
+                    found.add(thing_to_update.key)
+            s.add_all([TranslationCache(key=key, english=eng)
+                for key, eng in latest.items() if key not in found])
+            s.commit()
+        return 1
+
+    @retry(5)
+    def max_translation_entry_id(self):
+        with self as s:
+            return s.query(func.max(TranslationEntry.id)).scalar() or 0
+
+    @retry(5)
+    def translation_cache_rows(self):
+        with self as s:
+            return s.query(TranslationCache.key, TranslationCache.english).all()
+
+    @retry(5)
+    def translated_key_hashes(self):
+        with self as s:
+            return [h for h, in s.query(TranslationCache.key_hash).filter(
+                TranslationCache.english != TranslationCache.key).filter(TranslationCache.key_hash != None)]
+
+    @retry(5)
+    def translation_entries_since(self, id):
+        with self as s:
+            return s.query(TranslationEntry.id, TranslationEntry.key, TranslationEntry.english).filter(
+                TranslationEntry.id > id).order_by(TranslationEntry.id).all()
 
     @retry(5)
     def push_history(self, dt, payload):
@@ -115,21 +253,30 @@ class TranslationSQL(object):
         self.history_cache = []
 
     @retry(5)
-    def update_caches(self):
+    def update_caches(self, incremental=0):
+        """Rebuilds the cache table from the newest entry of each key.
+           incremental only redoes the keys with entries newer than the last
+           run in this process (and falls back to a full rebuild the first
+           time). Returns how many keys were redone."""
         with self as s:
-            transient = aliased(TranslationEntry)
-            result = s.query(TranslationEntry).filter(
-                s.query(func.count(transient.id))
-                .filter(transient.submit_utc >= TranslationEntry.submit_utc)
-                .filter(transient.key == TranslationEntry.key)
-                .order_by(transient.id.desc())
-                .correlate(TranslationEntry)
-                .as_scalar() == 1).all()
-            s.query(TranslationCache).delete()
-            cache_ents = [TranslationCache(key=x.key, english=x.english)
-                for x in result if x.key != x.english]
-            s.add_all(cache_ents)
+            max_id = s.query(func.max(TranslationEntry.id)).scalar() or 0
+            if incremental and self.caches_built_to is not None:
+                # Every key sharing a hash with a changed one is redone too,
+                # which keeps this right when hashes collide.
+                hashes = s.query(TranslationEntry.key_hash).filter(
+                    TranslationEntry.id > self.caches_built_to, TranslationEntry.id <= max_id).distinct()
+                s.query(TranslationCache).filter(TranslationCache.key_hash.in_(hashes.subquery())).delete(
+                    synchronize_session=False)
+                result = self.latest_entries(s, hashes.subquery(), TranslationEntry.key, TranslationEntry.english)
+            else:
+                s.query(TranslationCache).delete()
+                result = self.latest_entries(s, None, TranslationEntry.key, TranslationEntry.english)
+
+            s.bulk_insert_mappings(TranslationCache, [{"key": key, "english": english}
+                for key, english in result if key != english])
             s.commit()
+        self.caches_built_to = max_id
+        return len(result)
 
     def gen_presence(self, gacha_list):
         # 3, 1 is the regular gacha
@@ -233,7 +380,7 @@ class TranslationSQL(object):
     @retry(5)
     def _gacha_availability(self, cards, gacha_list):
         print("trace _gacha_availability", cards)
-        gacha_map = {x.id: x for x in gacha_list}
+        getgacha = self._gacha_getter(gacha_list)
 
         ga = defaultdict(lambda: [])
         for k in cards:
@@ -242,43 +389,53 @@ class TranslationSQL(object):
         with self as s:
             ents = s.query(GachaLookupEntry).filter(GachaLookupEntry.card_id.in_(cards)).all()
 
+        for e in ents:
+            ga[e.card_id].extend(self._gacha_presences(e, getgacha))
+        return ga
+
+    @staticmethod
+    def _gacha_getter(gacha_list):
+        gacha_map = {x.id: x for x in gacha_list}
+
         def getgacha(gid):
             if gid in gacha_map:
                 return gacha_map[gid]
             else:
                 return unknown_gacha_t("??? (unknown gacha ID: {0})".format(gid))
-
-        for e in ents:
-            recent = getgacha(e.last_gacha_id)
-            name = recent.name
-
-            # FIXME do this better
-            if name == "プラチナオーディションガシャ":
-                name = None
-
-            # We now display the last gacha the card was featured in, according
-            # to history. This means that we may show a past date, even though the card itself
-            # is still green.
-            ga[e.card_id].append(Availability(
+        return getgacha
+
+    @staticmethod
+    def _gacha_presences(e, getgacha):
+        recent = getgacha(e.last_gacha_id)
+        name = recent.name
+
+        # FIXME do this better
+        if name == "プラチナオーディションガシャ":
+            name = None
+
+        # We now display the last gacha the card was featured in, according
+        # to history. This means that we may show a past date, even though the card itself
+        # is still green.
+        ret = [Availability(
+            Availability._TYPE_GACHA,
+            name,
+            recent.start_date,
+            recent.end_date, [],
+            e.is_limited)]
+
+        # For limited cards, display the most recent and the first one it appeared in.
+        if e.first_gacha_id != e.last_gacha_id and e.is_limited:
+            first = getgacha(e.first_gacha_id)
+            name_first = first.name
+            if name_first == "プラチナオーディションガシャ":
+                name_first = None
+            ret.append(Availability(
                 Availability._TYPE_GACHA,
-                name,
-                recent.start_date,
-                recent.end_date, [],
+                name_first,
+                first.start_date,
+                first.end_date, [],
                 e.is_limited))
-
-            # For limited cards, display the most recent and the first one it appeared in.
-            if e.first_gacha_id != e.last_gacha_id and e.is_limited:
-                first = getgacha(e.first_gacha_id)
-                name_first = first.name
-                if name_first == "プラチナオーディションガシャ":
-                    name_first = None
-                ga[e.card_id].append(Availability(
-                    Availability._TYPE_GACHA,
-                    name_first,
-                    first.start_date,
-                    first.end_date, [],
-                    e.is_limited))
-        return ga
+        return ret
 
     @retry(5)
     def get_history(self, nent, page=0):
@@ -319,23 +476,176 @@ class TranslationSQL(object):
 
         return [buckets[eid.id] for eid in eids]
 
+    @retry(5)
+    def all_availability_lookups(self):
+        """Every row of the event and gacha lookup tables, for building
+           TranslationEngine's availability index."""
+        with self as s:
+            event_ents = s.query(EventLookupEntry).order_by(EventLookupEntry.card_id,
+                EventLookupEntry.event_id, EventLookupEntry.acquisition_type).all()
+            gacha_ents = s.query(GachaLookupEntry).order_by(GachaLookupEntry.card_id,
+                GachaLookupEntry.is_limited).all()
+        return event_ents, gacha_ents
+
+    def async_translations(self, keys):
+        return self.run_query(self.translations, keys)
+
+    def async_get_history(self, nent, page=0):
+        return self.run_query(self.get_history, nent, page)
+
 class TranslationEngine(TranslationSQL):
     def __init__(self, data_source, override_url=None):
         super().__init__(override_url)
         self.dsrc = data_source
         self.cache_id = -1
         self.k2r = {}
+        # ((truth version, generation), {card_id: [Availability, ...]})
+        # The generation goes up whenever the lookup tables are rewritten.
+        self.availability_index = (None, {})
+        self.availability_generation = 0
+        # (truth version, generation) -> the build of that index that's running
+        self.availability_rebuilds = {}
+        # (truth version, generation) and time of the last failed build
+        self.availability_failed = (None, 0)
+        data_source.version_listeners.append(self.version_published)
+        self.replica = TranslationReplica(self)
+        self.writer = TranslationWriteBehind(self)
+        self.dump = TranslationDump(self, self.replica)
 
     def kill_caches(self, dv):
         self.k2r = {x.kanji: x.conventional for _, x in self.dsrc.data.names.items()}
         self.availability_cache = {}
         self.cache_id = dv
 
+    def version_published(self, new_data):
+        # History is rewritten just before a new version goes live, so this
+        # also picks up the new lookup rows.
+        IOLoop.current().add_callback(self.start_availability_rebuild, new_data)
+
     def get_history(self, nent, page=0):
         return super().get_history(nent, page)
 
+    def queue_translation(self, key, eng, sender):
+        """Queues a submission for the next batch write. Returns whether it
+           was accepted (the queue is bounded)."""
+        if not self.writer.submit(key, eng, sender):
+            return 0
+        self.replica.put(key, eng)
+        return 1
+
+    async def translations_dropped(self, batch):
+        """The write-behind gave up on batch, which the replica (and maybe
+           the dump) already show. Both are reloaded from the database."""
+        await self.replica.invalidate()
+        # What's still queued isn't in the database yet either.
+        for key, eng, _, _ in self.writer.queue:
+            self.replica.put(key, eng)
+        await self.dump.invalidate()
+
+    async def async_update_caches(self, incremental=0):
+        await self.run_query(self.update_caches, incremental)
+        await self.replica.invalidate()
+        await self.dump.invalidate()
+
     def gacha_availability(self, cards, gacha_list):
         if self.cache_id != self.dsrc.data.version:
             self.kill_caches(self.dsrc.data.version)
 
         return super().gacha_availability(cards, gacha_list)
+
+    def availability_key(self, data):
+        return (data.version, self.availability_generation)
+
+    def invalidate_availability(self):
+        """For after the event or gacha lookup tables were rewritten. The old
+           index is served until the new one is built."""
+        self.availability_generation += 1
+        return self.start_availability_rebuild(self.dsrc.data)
+
+    def start_availability_rebuild(self, data):
+        """Starts building the availability index for data unless that's
+           already running, and returns the build. Only one ever runs per
+           version; everyone who needs it meanwhile waits on that one."""
+        key = self.availability_key(data)
+        flight = self.availability_rebuilds.get(key)
+        if flight is None:
+            flight = self.availability_rebuilds[key] = asyncio.ensure_future(
+                self.do_availability_rebuild(data, key))
+        return flight
+
+    async def do_availability_rebuild(self, data, key):
+        # No timeout: the worker can't be stopped, so the build counts as
+        # running until it returns, however long the tables take to scan.
+        try:
+            index = await self.run_query_to_end(self.build_availability_index, data)
+        except Exception as e:
+            print("TranslationEngine: availability index for {0} failed ({1!r})".format(data.version, e))
+            index = None
+        finally:
+            del self.availability_rebuilds[key]
+
+        if index is None:
+            self.availability_failed = (key, time.time())
+            return
+
+        # One for an older version or generation never replaces a newer one.
+        if self.availability_index[0] is None or self.availability_index[0] <= key:
+            self.availability_index = (key, index)
+
+    def build_availability_index(self, data):
+        lookups = self.all_availability_lookups()
+        if lookups is None:
+            print("TranslationEngine: couldn't read availability lookups, keeping the old index")
+            return None
+
+        event_ents, gacha_ents = lookups
+        eventset = {x.id: x for x in data.event_ids()}
+        getgacha = self._gacha_getter(data.gacha_ids())
+
+        # Rows pointing at events or gachas this truth doesn't have are
+        # left out, rather than breaking every page they'd show up on.
+        index = defaultdict(lambda: [])
+        seen = set()
+        skipped = 0
+        for e in event_ents:
+            x = eventset.get(e.event_id)
+            if x is None:
+                skipped += 1
+                continue
+            if (e.card_id, e.event_id) in seen:
+                continue
+            seen.add((e.card_id, e.event_id))
+            index[e.card_id].append(self.dsrc.Availability(
+                self.dsrc.Availability._TYPE_EVENT, x.name, x.start_date, x.end_date))
+
+        for e in gacha_ents:
+            try:
+                index[e.card_id].extend(self._gacha_presences(e, getgacha))
+            except AttributeError:
+                # unknown_gacha_t has no dates
+                skipped += 1
+
+        print("TranslationEngine: availability index for {0} built, {1} cards ({2} rows skipped)".format(
+            data.version, len(index), skipped))
+        return dict(index)
+
+    def availability(self, cards):
+        """Event and gacha availability of each card that has any, for the
+           card and chara pages: {card_id: [Availability, ...]}
+           Straight from the index as it is; async_availability keeps it
+           up to date."""
+        index = self.availability_index[1]
+        return {k: index[k] for k in cards if k in index}
+
+    async def async_availability(self, cards):
+        data = self.dsrc.data
+        key = self.availability_key(data)
+        failed_key, failed_at = self.availability_failed
+        if (self.availability_index[0] != key and
+                (failed_key != key or time.time() - failed_at >= AVAILABILITY_RETRY_INTERVAL)):
+            flight = self.start_availability_rebuild(data)
+            # The old index is served while a new one is built, but until
+            # the first one is there's nothing to serve.
+            if self.availability_index[0] is None:
+                await flight
+        return self.availability(cards)
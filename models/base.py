@@ -1,5 +1,6 @@
 import os
 import json
+import hashlib
 from datetime import datetime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, String, UnicodeText, LargeBinary, SmallInteger
@@ -19,11 +20,22 @@ if TABLE_PREFIX is None:
 
 Base = declarative_base()
 
+def key_hash(key):
+    """Fixed-width stand-in for a translation key, so lookups can use an
+       index on any database (MySQL can't index UnicodeText). It's the first
+       64 bits of SHA-256 in hex. Different keys can share one, so anything
+       that finds rows by it has to compare the key too."""
+    return hashlib.sha256(key.encode("utf8")).hexdigest()[:16]
+
+def key_hash_default(context):
+    return key_hash(context.get_current_parameters()["key"] or "")
+
 class TranslationEntry(Base):
     __tablename__ = TABLE_PREFIX + "_translation"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     key = Column(utext())
+    key_hash = Column(String(16), index=True, default=key_hash_default)
     english = Column(utext())
     submitter = Column(String(50))
     submit_utc = Column(Integer)
@@ -36,6 +48,7 @@ class TranslationCache(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     key = Column(utext(), index=True)
+    key_hash = Column(String(16), index=True, default=key_hash_default)
     english = Column(utext())
 
     def __repr__(self):
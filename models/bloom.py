@@ -0,0 +1,36 @@
+import math
+
+# Set membership in about 10 bits per key at a 1% false positive rate:
+# "no" is always right, "yes" is wrong about error_rate of the time.
+# Items are key_hash() strings, which are already uniformly distributed, so
+# the k bit positions come straight from their two 32-bit halves
+# (Kirsch-Mitzenmacher double hashing) rather than from k more hashes.
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.nbits = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 64)
+        self.nhashes = max(int(round(self.nbits / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.nbits + 7) // 8)
+        self.count = 0
+
+    def positions(self, hashed):
+        value = int(hashed, 16)
+        h1, h2 = value & 0xFFFFFFFF, (value >> 32) | 1
+        return ((h1 + i * h2) % self.nbits for i in range(self.nhashes))
+
+    def add(self, hashed):
+        for pos in self.positions(hashed):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, hashed):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(hashed))
+
+    def expected_error_rate(self):
+        """False positive rate for what's been added so far."""
+        return (1 - math.exp(-self.nhashes * self.count / self.nbits)) ** self.nhashes
+
+    def describe(self):
+        return {"keys": self.count, "bytes": len(self.bits), "hashes": self.nhashes,
+            "expected_error_rate": self.expected_error_rate()}
@@ -0,0 +1,50 @@
+import asyncio
+from collections import Counter
+from tornado.ioloop import IOLoop
+
+# Merges key lookups that arrive within `window` seconds of each other into
+# one call to fetch(keys), which takes a list of unique keys and returns a
+# {key: value} dict for the ones it found. Every caller gets its own subset
+# of the result back. A batch is sent early once it has max_keys keys.
+
+class KeyLookupCoalescer(object):
+    def __init__(self, fetch, window, max_keys=500):
+        self.fetch = fetch
+        self.window = window
+        self.max_keys = max_keys
+        self.pending = None
+        self.stats = Counter()
+
+    async def get(self, keys):
+        if self.pending is None:
+            self.pending = (set(), asyncio.get_event_loop().create_future(),
+                IOLoop.current().call_later(self.window, self.flush))
+        else:
+            self.stats["coalesced"] += 1
+
+        batch, done, _ = self.pending
+        batch.update(keys)
+        self.stats["request"] += 1
+        if len(batch) >= self.max_keys:
+            self.flush()
+
+        found = await done
+        return {k: found[k] for k in keys if k in found}
+
+    def flush(self):
+        if self.pending is None:
+            return
+
+        batch, done, timeout = self.pending
+        self.pending = None
+        IOLoop.current().remove_timeout(timeout)
+        self.stats["batch"] += 1
+        self.stats["key"] += len(batch)
+        asyncio.ensure_future(self.run_batch(list(batch), done))
+
+    async def run_batch(self, keys, done):
+        try:
+            done.set_result(await self.fetch(keys) or {})
+        except Exception as e:
+            self.stats["error"] += 1
+            done.set_exception(e)
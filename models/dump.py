@@ -0,0 +1,142 @@
+import os
+import json
+import gzip
+import asyncio
+from collections import namedtuple, OrderedDict, Counter
+from tornado.ioloop import IOLoop
+
+# The whole translation cache as one JSON document (plus a gzipped copy),
+# for /api/v1/tl_dump. Its revision is the highest TranslationEntry id it
+# includes, so a client holding revision R only needs the entries after R.
+# - Every TL_DUMP_INTERVAL seconds it checks whether that id moved, and
+#   builds a new snapshot in the background if it did.
+# - It's built from the replica when that's loaded, from the cache table
+#   otherwise.
+# - The revision is read before the translations, so a snapshot can
+#   contain a few entries newer than it says. Applying those again from a
+#   delta changes nothing.
+# - Deltas are a few entries and come from the entry table; the last
+#   DELTA_CACHE_SIZE are kept until the revision moves. A delta can be
+#   newer than the snapshot, and a client can ask for the next delta from
+#   either one.
+
+TL_DUMP_INTERVAL = int(os.getenv("TL_DUMP_INTERVAL", "60"))
+
+dump_t = namedtuple("dump_t", ("revision", "body", "gzipped"))
+
+def encode_dump(revision, translations, since=None):
+    doc = {"revision": revision, "translations": translations}
+    if since is not None:
+        doc["since"] = since
+    body = json.dumps(doc, ensure_ascii=0, sort_keys=1, separators=(",", ":")).encode("utf8")
+    return dump_t(revision, body, gzip.compress(body))
+
+class TranslationDump(object):
+    DELTA_CACHE_SIZE = 16
+
+    def __init__(self, sql, replica, interval=TL_DUMP_INTERVAL):
+        self.sql = sql
+        self.replica = replica
+        self.interval = interval
+        self.snapshot = None
+        self.deltas = OrderedDict()
+        # the highest revision any delta has been built up to
+        self.newest_served = 0
+        self.stale = 0
+        self.building = None
+        self.next_build = None
+        self.stats = Counter()
+
+    async def get(self):
+        if self.snapshot is None:
+            await self.refresh()
+        return self.snapshot
+
+    def invalidate(self):
+        """Forces a new snapshot, for when the cache table was rebuilt."""
+        self.stale = 1
+        return self.refresh()
+
+    def refresh(self):
+        """Starts a rebuild check unless one is already running, and returns it."""
+        if self.building is None:
+            self.building = asyncio.ensure_future(self.do_refresh())
+        return self.building
+
+    async def current_revision(self):
+        if self.replica.entries is not None:
+            return self.replica.max_id
+
+        revision = await self.sql.run_query(self.sql.max_translation_entry_id)
+        if revision is None:
+            raise ValueError("couldn't read the max entry id")
+        return revision
+
+    async def do_refresh(self):
+        loop = IOLoop.current()
+        try:
+            revision = await self.current_revision()
+            if self.stale or self.snapshot is None or revision != self.snapshot.revision:
+                await self.build(revision)
+        except Exception as e:
+            print("TranslationDump: build failed ({0!r})".format(e))
+            self.stats["error"] += 1
+        finally:
+            self.building = None
+
+        if self.next_build is not None:
+            loop.remove_timeout(self.next_build)
+        self.next_build = loop.call_later(self.interval, self.refresh)
+
+    async def build(self, revision):
+        self.stale = 0
+        if self.replica.entries is not None:
+            translations = dict(self.replica.entries)
+        else:
+            rows = await self.sql.run_query(self.sql.translation_cache_rows)
+            if rows is None:
+                raise ValueError("couldn't read the translation cache")
+            translations = {key: english for key, english in rows if english != key}
+
+        self.snapshot = await IOLoop.current().run_in_executor(None, encode_dump, revision, translations)
+        self.deltas.clear()
+        self.newest_served = 0
+        self.stats["build"] += 1
+
+    async def delta(self, since):
+        """Everything translated after revision `since`, as a dump_t whose
+           translations map untranslated keys to None. Returns None if
+           `since` isn't a revision this dump can continue from."""
+        snapshot = await self.get()
+        if snapshot is None:
+            return None
+
+        delta = self.deltas.get(since)
+        if delta is not None:
+            self.deltas.move_to_end(since)
+            self.stats["delta_hit"] += 1
+            return delta
+
+        # A delta's revision can be past the snapshot's, and clients chain
+        # from it, so anything up to the newest revision handed out or known
+        # (the replica's, without asking the database when it's loaded) is
+        # fine.
+        if since > max(snapshot.revision, self.newest_served):
+            if since > await self.current_revision():
+                return None
+
+        rows = await self.sql.run_query(self.sql.translation_entries_since, since)
+        if rows is None:
+            raise ValueError("couldn't read new translation entries")
+
+        # Rows are in id order, so later entries for a key win.
+        changes = {key: english if english != key else None for _, key, english in rows}
+        revision = max([since, snapshot.revision] + [id for id, _, _ in rows])
+        delta = await IOLoop.current().run_in_executor(None, encode_dump, revision, changes, since)
+        self.newest_served = max(self.newest_served, revision)
+        if snapshot is self.snapshot:
+            self.deltas[since] = delta
+            if len(self.deltas) > self.DELTA_CACHE_SIZE:
+                self.deltas.popitem(last=False)
+        self.stats["delta"] += 1
+        return delta
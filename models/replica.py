@@ -0,0 +1,180 @@
+import os
+import time
+import asyncio
+from collections import Counter
+from tornado.ioloop import IOLoop
+
+from .base import key_hash
+from .bloom import BloomFilter
+from .coalesce import KeyLookupCoalescer
+
+# A copy of the whole translation cache table in memory, so read_tl never
+# has to go to the database.
+# - It's loaded once, then kept fresh by applying every TranslationEntry
+#   with an id above the highest one we've seen, every TL_SYNC_INTERVAL
+#   seconds. Entries are applied in id order, which is the order
+#   set_translation wrote them to the cache table.
+# - Our own writes go in straight away (write-through), the sync picks up
+#   everyone else's.
+# - If the entry table shrinks under us (delete_all_entries), or the cache
+#   table is rebuilt (update_caches), it starts over with a full load.
+# - Until a load succeeds, lookups go to the database, but every lookup
+#   arriving within READ_TL_BATCH_MS of the first becomes one query.
+# - With TL_REPLICA=0 it never loads, and only keeps a Bloom filter of the
+#   translated keys' hashes (a couple of bytes each), rebuilt every
+#   TL_BLOOM_INTERVAL seconds. Keys the filter has never seen don't go to
+#   the database. Our own writes are added to it straight away, everyone
+#   else's turn up at the next rebuild.
+
+TL_SYNC_INTERVAL = int(os.getenv("TL_SYNC_INTERVAL", "30"))
+READ_TL_BATCH_MS = int(os.getenv("READ_TL_BATCH_MS", "10"))
+TL_REPLICA = int(os.getenv("TL_REPLICA", "1"))
+TL_BLOOM_INTERVAL = int(os.getenv("TL_BLOOM_INTERVAL", "300"))
+TL_BLOOM_ERROR_RATE = float(os.getenv("TL_BLOOM_ERROR_RATE", "0.01"))
+
+class TranslationReplica(object):
+    def __init__(self, sql, interval=TL_SYNC_INTERVAL, enabled=TL_REPLICA):
+        self.sql = sql
+        self.interval = interval
+        self.enabled = enabled
+        self.entries = None
+        self.bloom = None
+        self.bloom_built = 0
+        # hashes put() while a rebuild is reading the table, which may have
+        # missed them
+        self.bloom_added = None
+        self.max_id = 0
+        self.stale = 0
+        self.syncing = None
+        self.next_sync = None
+        self.stats = Counter()
+        self.fallback = KeyLookupCoalescer(self.lookup_in_db, READ_TL_BATCH_MS / 1000)
+
+    async def lookup(self, keys):
+        """{key: english} for the keys that have a translation."""
+        if self.entries is None and (self.enabled or self.bloom is None):
+            await self.sync()
+
+        self.stats["lookup"] += 1
+        self.stats["key"] += len(keys)
+        if self.entries is None:
+            self.stats["fallback"] += 1
+            if self.bloom is not None:
+                maybe = [k for k in keys if key_hash(k) in self.bloom]
+                self.stats["bloom_skipped"] += len(keys) - len(maybe)
+                if not maybe:
+                    return {}
+                found = await self.fallback.get(maybe)
+                self.stats["bloom_passed"] += len(maybe)
+                self.stats["bloom_false_positive"] += len(maybe) - len(found)
+                return found
+            return await self.fallback.get(keys)
+
+        entries = self.entries
+        return {k: entries[k] for k in keys if k in entries}
+
+    async def lookup_in_db(self, keys):
+        rows = await self.sql.async_translations(keys)
+        if rows is None:
+            raise ValueError("couldn't read translations")
+        return {tlo.key: tlo.english for tlo in rows if tlo.english != tlo.key}
+
+    def put(self, key, english):
+        if not self.enabled and english != key:
+            hashed = key_hash(key)
+            if self.bloom is not None:
+                self.bloom.add(hashed)
+            if self.bloom_added is not None:
+                self.bloom_added.append(hashed)
+        if self.entries is None:
+            return
+
+        if english != key:
+            self.entries[key] = english
+        else:
+            self.entries.pop(key, None)
+        self.stats["write_through"] += 1
+
+    def invalidate(self):
+        """Forces a full load, for when the cache table was rebuilt."""
+        self.stale = 1
+        return self.sync()
+
+    def sync(self):
+        """Starts a sync unless one is already running, and returns it."""
+        if self.syncing is None:
+            self.syncing = asyncio.ensure_future(self.do_sync())
+        return self.syncing
+
+    async def do_sync(self):
+        loop = IOLoop.current()
+        try:
+            if self.enabled:
+                await self.sync_entries()
+            elif self.stale or time.time() >= self.bloom_built + TL_BLOOM_INTERVAL:
+                await self.load_bloom()
+        except Exception as e:
+            print("TranslationReplica: sync failed ({0!r})".format(e))
+            self.stats["error"] += 1
+        finally:
+            self.syncing = None
+
+        if self.next_sync is not None:
+            loop.remove_timeout(self.next_sync)
+        self.next_sync = loop.call_later(self.interval, self.sync)
+
+    async def sync_entries(self):
+        max_id = await self.sql.run_query(self.sql.max_translation_entry_id)
+        if max_id is None:
+            raise ValueError("couldn't read the max entry id")
+
+        if self.entries is None or self.stale or max_id < self.max_id:
+            await self.full_load(max_id)
+        elif max_id > self.max_id:
+            await self.apply_delta()
+
+    async def full_load(self, max_id):
+        # Read the id first: anything written while the table is being read
+        # comes around again in the next delta, and applying it twice is fine.
+        self.stale = 0
+        rows = await self.sql.run_query(self.sql.translation_cache_rows)
+        if rows is None:
+            raise ValueError("couldn't read the translation cache")
+
+        self.entries = {key: english for key, english in rows if english != key}
+        self.max_id = max_id
+        self.stats["full_load"] += 1
+
+    async def load_bloom(self):
+        self.stale = 0
+        self.bloom_added = []
+        try:
+            hashes = await self.sql.run_query(self.sql.translated_key_hashes)
+        finally:
+            added, self.bloom_added = self.bloom_added, None
+        if hashes is None:
+            raise ValueError("couldn't read the translated key hashes")
+
+        # Leave room for the keys that get translated before the next rebuild.
+        bloom = BloomFilter(int(len(hashes) * 1.25) + 1000, TL_BLOOM_ERROR_RATE)
+        for h in hashes:
+            bloom.add(h)
+        for h in added:
+            bloom.add(h)
+        self.bloom = bloom
+        self.bloom_built = time.time()
+        self.stats["bloom_load"] += 1
+
+    async def apply_delta(self):
+        rows = await self.sql.run_query(self.sql.translation_entries_since, self.max_id)
+        if rows is None:
+            raise ValueError("couldn't read new translation entries")
+
+        for id, key, english in rows:
+            if english != key:
+                self.entries[key] = english
+            else:
+                self.entries.pop(key, None)
+            self.max_id = max(self.max_id, id)
+        self.stats["delta"] += 1
+        self.stats["delta_rows"] += len(rows)
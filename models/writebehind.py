@@ -0,0 +1,95 @@
+import os
+import asyncio
+import time
+from collections import deque, Counter
+from tornado.ioloop import IOLoop
+
+# Queues translation submissions and writes them in batches, so send_tl
+# only has to append to a list. A batch goes out TL_WRITE_FLUSH_MS after
+# the first submission in it, or as soon as TL_WRITE_BATCH are waiting.
+# - At most TL_WRITE_QUEUE_MAX submissions wait at once; past that they're
+#   refused and send_tl says so.
+# - A batch the database refused goes back to the front of the queue.
+#   Writes aren't given up on after TLE_DB_TIMEOUT like other queries: the
+#   replica already shows what's in a batch, so whether it made it has to
+#   be known. One that may have, being requeued, would write twice.
+# - A batch that failed outright (an error retrying won't fix) is dropped,
+#   and the replica and dump are reloaded so they stop showing it.
+# - drain() writes out whatever is left, for shutdown.
+
+TL_WRITE_BATCH = int(os.getenv("TL_WRITE_BATCH", "100"))
+TL_WRITE_FLUSH_MS = int(os.getenv("TL_WRITE_FLUSH_MS", "1000"))
+TL_WRITE_QUEUE_MAX = int(os.getenv("TL_WRITE_QUEUE_MAX", "10000"))
+
+class TranslationWriteBehind(object):
+    def __init__(self, sql, batch=TL_WRITE_BATCH, delay=TL_WRITE_FLUSH_MS / 1000,
+                 limit=TL_WRITE_QUEUE_MAX):
+        self.sql = sql
+        self.batch = batch
+        self.delay = delay
+        self.limit = limit
+        self.queue = deque()
+        self.timer = None
+        self.flushing = None
+        self.stats = Counter()
+
+    def submit(self, key, eng, sender, force_time=None):
+        """Returns whether the submission was queued."""
+        if len(self.queue) >= self.limit:
+            self.stats["rejected"] += 1
+            return 0
+
+        self.queue.append((key, eng, sender, force_time or int(time.time())))
+        self.stats["submitted"] += 1
+        if len(self.queue) >= self.batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = IOLoop.current().call_later(self.delay, self.flush)
+        return 1
+
+    def flush(self):
+        if self.timer is not None:
+            IOLoop.current().remove_timeout(self.timer)
+            self.timer = None
+
+        if self.flushing is None and self.queue:
+            self.flushing = asyncio.ensure_future(self.do_flush())
+        return self.flushing
+
+    def take_batch(self):
+        return [self.queue.popleft() for _ in range(min(len(self.queue), self.batch))]
+
+    async def do_flush(self):
+        try:
+            while self.queue:
+                batch = self.take_batch()
+                try:
+                    written = await self.sql.run_query_to_end(self.sql.set_translations, batch)
+                except Exception as e:
+                    print("TranslationWriteBehind: dropped a batch of {0} ({1!r})".format(len(batch), e))
+                    self.stats["dropped"] += len(batch)
+                    await self.sql.translations_dropped(batch)
+                    continue
+
+                if not written:
+                    self.queue.extendleft(reversed(batch))
+                    self.stats["error"] += 1
+                    break
+
+                self.stats["batch"] += 1
+                self.stats["written"] += len(batch)
+        finally:
+            self.flushing = None
+
+        if self.queue and self.timer is None:
+            self.timer = IOLoop.current().call_later(self.delay, self.flush)
+
+    def drain(self):
+        """Synchronously writes out everything still queued."""
+        while self.queue:
+            batch = self.take_batch()
+            if not self.sql.set_translations(batch):
+                print("TranslationWriteBehind: lost {0} submissions at shutdown".format(
+                    len(batch) + len(self.queue)))
+                return
+            self.stats["written"] += len(batch)
@@ -1,13 +1,18 @@
 import re
+import json
+import glob
 import sqlite3
 import pickle
 import os
 import subprocess
 import sys
+import threading
 from time import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import pathname2url
 from datetime import datetime, timedelta
 from pytz import timezone, utc
-from functools import lru_cache, partial
+from functools import partial
 from collections import defaultdict, namedtuple, Counter
 from tornado import ioloop
 
@@ -17,6 +22,13 @@ from . import apiclient
 from . import acquisition
 from . import extra_va_tables
 from . import update
+from . import snapshot
+from .intervals import IntervalIndex
+from .store import ColumnStore, link, split_links
+from .ttlcache import TTLCache
+from .fragments import FragmentCache
+from .suggest import SuggestIndex
+from . import signatures
 
 ark_data_path = partial(os.path.join, "_data", "ark")
 private_data_path = partial(os.path.join, "_data", "private")
@@ -77,16 +89,6 @@ def determine_best_stat(vo, vi, da):
     else:
         return BALANCED + hi_typ
 
-def paginate_id_list(idl, pagesize=500):
-    start = 0
-    step = pagesize
-    while 1:
-        page = idl[start:start + step]
-        if not page:
-            break
-        yield page
-        start += step
-
 Availability = namedtuple("Availability", ("type", "name", "start", "end"))
 Availability._TYPE_GACHA = 1
 Availability._TYPE_EVENT = 2
@@ -106,26 +108,141 @@ TITLE_ONLY_REGEX = r"^［(.+)］"
 NAME_ONLY_REGEX = r"^(?:［.+］)?(.+)$"
 AWAKENED_SYMBOL = "＋"
 
+# How long live gacha rates are served before being refreshed in the background.
+GACHA_RATES_TTL = int(os.getenv("GACHA_RATES_TTL", "900"))
+
+# Memory budget for rendered HTML kept per version (see fragments.py).
+FRAGMENT_CACHE_BYTES = int(os.getenv("FRAGMENT_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# Same, for whole responses.
+RESPONSE_CACHE_BYTES = int(os.getenv("RESPONSE_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# Per connection. The mdb is never written once downloaded, so every
+# thread can map the whole thing and share the pages.
+MDB_MMAP_SIZE = 256 * 1024 * 1024
+
+# The async_* query methods on DataCache run here, so a slow query only
+# ties up one of these threads instead of the IOLoop.
+query_pool = ThreadPoolExecutor(max_workers=int(os.getenv("MDB_QUERY_THREADS", "4")),
+    thread_name_prefix="mdb-query")
+
+def open_mdb(path):
+    # immutable=1 lets sqlite skip locking and change detection entirely.
+    uri = "file:{0}?mode=ro&immutable=1".format(pathname2url(os.path.abspath(path)))
+    # close() may be called from a different thread than the one that
+    # opened the handle, hence check_same_thread=False.
+    hnd = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    hnd.execute("PRAGMA mmap_size = {0}".format(MDB_MMAP_SIZE))
+    return hnd
+
+def _probe_json_each():
+    try:
+        sqlite3.connect(":memory:").execute("SELECT value FROM json_each('[]')")
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+# Bulk ID lookups bind the whole ID list as one parameter, so each lookup
+# is a single statement with the same text no matter how many IDs there
+# are. Builds of sqlite without JSON1 get a per-connection temp table instead.
+HAVE_JSON_EACH = _probe_json_each()
+
+def describe_or_placeholder(describe, skill):
+    """describe(skill), or a placeholder if it raises (say, on a skill type
+       en.py doesn't know yet), so one skill can't stop a version loading."""
+    try:
+        return describe(skill)
+    except Exception as e:
+        print("couldn't describe skill {0} ({1!r})".format(skill.id, e))
+        return en.UNDESCRIBABLE_SKILL
+
+def _materialize(func, *args):
+    return list(func(*args))
+
 class DataCache(object):
-    def __init__(self, version):
+    def __init__(self, version, use_snapshot=1):
         self.version = version
         self.load_date = datetime.utcnow()
-        self.hnd = sqlite3.connect(transient_data_path("{0}.mdb".format(version)))
+        self.mdb_path = transient_data_path("{0}.mdb".format(version))
+        self.local = threading.local()
+        self.connections = []
+        self.pins = 0
+        self.retired = 0
         self.class_cache = {}
-        self.prime_caches()
+        self.prime_caches(use_snapshot)
         self.reset_statistics()
+        self.prime_indexes()
+        self.tlable_signatures = signatures.sign_all(self.tlable_strings())
         self.load_date_jst = datetime.now(_JST).strftime('%Y-%m-%d %H:%M:%S.%f (JST)')# Just like utc format
 
         self.live_cache = {
-            "gacha": {}
+            "gacha": TTLCache(self.fetch_live_gacha_rates, GACHA_RATES_TTL)
         }
+        self.fragments = FragmentCache(FRAGMENT_CACHE_BYTES)
+        # See dispatch.ResponseCacheMixin.
+        self.responses = FragmentCache(RESPONSE_CACHE_BYTES,
+            sizeof=lambda r: len(r.body) + len(r.gzipped))
+
+    @property
+    def hnd(self):
+        """The calling thread's read-only connection to the mdb."""
+        hnd = getattr(self.local, "hnd", None)
+        if hnd is None:
+            hnd = self.local.hnd = open_mdb(self.mdb_path)
+            self.connections.append(hnd)
+        return hnd
+
+    def execute_id_set(self, query, ids):
+        """Runs query with {0} replaced by a subquery yielding ids.
+           The query must not take any other parameters."""
+        if HAVE_JSON_EACH:
+            return self.hnd.execute(query.format("(SELECT value FROM json_each(?))"),
+                (json.dumps(list(ids)),))
+
+        hnd = self.hnd
+        hnd.execute("CREATE TEMP TABLE IF NOT EXISTS id_set (id INTEGER PRIMARY KEY)")
+        hnd.execute("DELETE FROM temp.id_set")
+        hnd.executemany("INSERT OR IGNORE INTO temp.id_set VALUES (?)", ((x,) for x in ids))
+        # Drained here, so the next lookup on this thread can reuse the table.
+        return hnd.execute(query.format("(SELECT id FROM temp.id_set)")).fetchall()
+
+    def run_query(self, func, *args):
+        """Runs func(*args) on the query pool. Returns an awaitable.
+           The version is pinned until func returns, so its handles aren't
+           closed under the worker if it's swapped out meanwhile."""
+        self.pin()
+        future = ioloop.IOLoop.current().run_in_executor(query_pool, partial(func, *args))
+        future.add_done_callback(lambda _: self.unpin())
+        return future
 
     def reset_statistics(self):
         self.vc_this = 0
         self.primed_this = Counter()
 
-    @lru_cache(1)
+    def prime_indexes(self):
+        # Kept on the instance rather than behind lru_cache, which is one
+        # cache for the whole process: a version being built next to the
+        # live one would evict the live one's entries.
+        self._gacha_ids = self.load_gacha_ids()
+        self._event_ids = self.load_event_ids()
+        self._gacha_index = IntervalIndex(self._gacha_ids)
+        self._event_index = IntervalIndex(self._event_ids)
+        self._chara_id_to_cards = self.load_chara_id_to_cards()
+        self._birthdays = self.load_birthdays()
+
     def gacha_ids(self):
+        return self._gacha_ids
+
+    def event_ids(self):
+        return self._event_ids
+
+    def gacha_index(self):
+        return self._gacha_index
+
+    def event_index(self):
+        return self._event_index
+
+    def load_gacha_ids(self):
         gachas = []
         gacha_stub_t = namedtuple("gacha_stub_t", ("id", "name", "start_date", "end_date", "type", "subtype", "rates"))
         stub_query = """SELECT gacha_data.id, gacha_data.name, start_date, end_date, type, type_detail,
@@ -138,8 +255,7 @@ class DataCache(object):
         self.primed_this["sel_gacha"] += 1
         return sorted(gachas, key=lambda x: x.start_date)
 
-    @lru_cache(1)
-    def event_ids(self):
+    def load_event_ids(self):
         events = []
         event_stub_t = namedtuple("event_stub_t", ("id", "name", "start_date", "end_date"))
 
@@ -151,11 +267,10 @@ class DataCache(object):
         return sorted(events, key=lambda x: x.start_date)
 
     def gachas(self, when):
-        select = []
-        for stub in reversed(self.gacha_ids()):
-            if stub.start_date <= when < stub.end_date:
-                select.append(stub)
-        return select
+        return self.gacha_index().at(when)
+
+    def gachas_between(self, t1, t2):
+        return self.gacha_index().between(t1, t2)
 
     def available_cards(self, gacha):
         has_legacy_available_data, = self.hnd.execute("SELECT count(0) FROM gacha_available WHERE gacha_id = ?", (gacha.id,)).fetchone()
@@ -173,27 +288,24 @@ class DataCache(object):
         select = [gacha.id for gacha in gachas]
 
         tmp = defaultdict(lambda: [])
-        lastlen = 0
-        for page in paginate_id_list(select):
-            self.primed_this["sel_la"] += 1
-            if lastlen != len(page):
-                query = "SELECT gacha_id, reward_id FROM gacha_available WHERE limited_flag == 1 AND gacha_id IN ({0})".format(",".join("?" * len(select)))
-                query_2 = "SELECT gacha_id, card_id FROM gacha_available_2 WHERE limited_flag == 1 AND gacha_id IN ({0})".format(",".join("?" * len(select)))
-
-            for gid, reward in self.hnd.execute(query, page):
-                if reward in self.fix_limited:
-                    # XXX we only support negative fixes for now
-                    continue
-                tmp[gid].append(reward)
+        self.primed_this["sel_la"] += 1
+        query = "SELECT gacha_id, reward_id FROM gacha_available WHERE limited_flag == 1 AND gacha_id IN {0}"
+        query_2 = "SELECT gacha_id, card_id FROM gacha_available_2 WHERE limited_flag == 1 AND gacha_id IN {0}"
 
-            try:
-                q2_iterator = self.hnd.execute(query_2, page)
-            except sqlite3.OperationalError:
+        for gid, reward in self.execute_id_set(query, select):
+            if reward in self.fix_limited:
+                # XXX we only support negative fixes for now
                 continue
+            tmp[gid].append(reward)
+
+        try:
+            q2_iterator = self.execute_id_set(query_2, select)
+        except sqlite3.OperationalError:
+            q2_iterator = ()
 
-            for gid, reward in q2_iterator:
-                if reward not in self.fix_limited and reward not in tmp[gid]:
-                    tmp[gid].append(reward)
+        for gid, reward in q2_iterator:
+            if reward not in self.fix_limited and reward not in tmp[gid]:
+                tmp[gid].append(reward)
 
         return [tmp[gacha.id] for gacha in gachas]
 
@@ -201,12 +313,10 @@ class DataCache(object):
         return self.limited_availability(TODAY())
 
     def events(self, when):
-        select = []
-        for stub in reversed(self.event_ids()):
-            if stub.start_date <= when < stub.end_date:
-                select.append(stub)
+        return self.event_index().at(when)
 
-        return select
+    def events_between(self, t1, t2):
+        return self.event_index().between(t1, t2)
 
     def current_events(self):
         return self.events(TODAY())
@@ -275,14 +385,59 @@ class DataCache(object):
         names = {k: v for k, v in names.items() if k in valid_char_ids}
         return names
 
-    def prime_caches(self):
-        self.names = self.load_names()
+    def snapshot_path(self):
+        return transient_data_path("{0}.snapshot".format(self.version))
+
+    def snapshot_sources(self):
+        return sorted(glob.glob(private_data_path("*.csv"))) + [transient_data_path("names.csv")]
+
+    def snapshot_code(self):
+        """Source files of the modules whose code shapes what's saved."""
+        modules = (__name__, "csvloader", en.__name__, extra_va_tables.__name__,
+            snapshot.__name__, "starlight.store")
+        return sorted(sys.modules[name].__file__ for name in modules)
+
+    def prime_caches(self, use_snapshot=1):
+        start = time()
+        key = snapshot.compute_key(self.version, self.snapshot_sources(), self.snapshot_code())
+        saved = snapshot.read(self.snapshot_path(), key) if use_snapshot else None
+
+        if saved:
+            self.restore_snapshot(saved)
+        else:
+            self.prime_from_sources()
+
         self.kanji_to_name = {v.kanji: v.conventional for v in self.names.values()}
+        self.overridden_events = set(x.event_id for x in self.ea_overrides)
+        self.suggest_index = SuggestIndex(self.names)
+        self.prime_master_tables()
+
+        if not saved:
+            snapshot.write(self.snapshot_path(), self.make_snapshot(key))
+
+        print("DataCache {0}: primed in {1:.3f}s ({2})".format(self.version,
+            time() - start, "from snapshot" if saved else "full"))
+
+    def prime_from_sources(self):
+        self.replay_tables = {}
+        self.names = self.load_names()
 
         self.ea_overrides = list(load_db_file(private_data_path("event_availability_overrides.csv")))
         self.fix_limited = load_keyed_db_file(private_data_path("gacha_availability_overrides.csv"))
-        self.overridden_events = set(x.event_id for x in self.ea_overrides)
 
+        self.chain_id = {}
+        self.id_chain = defaultdict(lambda: [])
+        chain_cur = self.hnd.execute("SELECT id, series_id FROM card_data WHERE album_id > 0")
+        for p in self.prime_from_cursor("chain_id_t", chain_cur):
+            self.chain_id[p.id] = p.series_id
+            self.id_chain[p.series_id].append(p.id)
+
+        self.char_store = self.load_chars()
+        self.card_store = self.load_cards()
+
+    def prime_master_tables(self):
+        # These are small, so snapshots keep the raw rows and they get
+        # primed again either way. (chance/dur can't be pickled.)
         prob_def = self.keyed_prime_from_table("probability_type")
         time_def = self.keyed_prime_from_table("available_time_type")
 
@@ -290,25 +445,106 @@ class DataCache(object):
             chance=lambda obj: partial(skill_chance, prob_def, obj.probability_type),
             dur=lambda obj: partial(skill_dur, time_def, obj.available_time_type),
             max_chance=lambda obj: prob_def[obj.probability_type].probability_max,
-            max_duration=lambda obj: time_def[obj.available_time_type].available_time_max)
-        self._lead_skills = self.keyed_prime_from_table("leader_skill_data")
+            max_duration=lambda obj: time_def[obj.available_time_type].available_time_max,
+            # Filled in below, since they need chance and dur.
+            description_html=lambda obj: None,
+            description=lambda obj: None)
+        for id, skill in self._skills.items():
+            html = describe_or_placeholder(en.describe_skill_html, skill)
+            self._skills[id] = skill._replace(description_html=html, description=en.REMOVE_HTML.sub("", html))
+
+        self._lead_skills = self.keyed_prime_from_table("leader_skill_data",
+            description_html=partial(describe_or_placeholder, en.describe_lead_skill_html),
+            description=partial(describe_or_placeholder, en.describe_lead_skill))
         self.rarity_dep = self.keyed_prime_from_table("card_rarity")
+        self.prime_voice_index()
 
-        self.chain_id = {}
-        self.id_chain = defaultdict(lambda: [])
-        chain_cur = self.hnd.execute("SELECT id, series_id FROM card_data WHERE album_id > 0")
-        for p in self.prime_from_cursor("chain_id_t", chain_cur):
-            self.chain_id[p.id] = p.series_id
-            self.id_chain[p.series_id].append(p.id)
+    def prime_voice_index(self):
+        cursor = self.replay_query("card_comments",
+            "SELECT id, use_type, `index`, voice_flag, discription, 0 AS n1 FROM card_comments")
+        lines = defaultdict(lambda: [])
+        for line in self.prime_from_cursor("va_data_t", cursor):
+            lines[line.id].append(line)
+
+        self.va_index = {}
+        if not lines:
+            return
+
+        r_va_data_t, va_data_t = self.class_cache.get("va_data_t")
+        for id, ret in lines.items():
+            if ret[0].voice_flag:
+                if id in self.char_store:
+                    extra = extra_va_tables.char_voices(va_data_t, id)
+                else:
+                    extra = extra_va_tables.card_voices(va_data_t, id, self.chain_id.get(id))
+            else:
+                extra = ()
+
+            self.va_index[id] = tuple(extra) + tuple(ret)
+
+    def tlable_strings(self):
+        """The master data strings that pages run through tlable(), the way
+           it signs them (newlines as spaces)."""
+        strings = set()
+        for card in self.cards(self.card_store.keys()):
+            if card.title_flag:
+                strings.add(card.title)
+        strings.update(s.skill_name for s in self._skills.values())
+        strings.update(s.name for s in self._lead_skills.values())
+        strings.update(e.name for e in self.event_ids())
+        strings.update(g.name for g in self.gacha_ids())
+
+        # as va_table_partial.html shows them
+        for lines in self.va_index.values():
+            for id, usage, index, voice, text, override_utype in lines:
+                strings.add("USE_TYPE__T_{0}".format(override_utype or usage))
+                try:
+                    strings.add(text.format("[Producer]"))
+                except (IndexError, KeyError, ValueError):
+                    pass
+
+        return (s.replace("\n", " ") for s in strings if s)
+
+    def make_snapshot(self, key):
+        return {
+            "key": key,
+            "names": snapshot.freeze_keyed(self.names),
+            "ea_overrides": snapshot.freeze_records(self.ea_overrides),
+            "fix_limited": snapshot.freeze_keyed(self.fix_limited),
+            "tables": self.replay_tables,
+            "chain_id": self.chain_id,
+            "id_chain": dict(self.id_chain),
+            "char_store": self.char_store,
+            "card_store": self.card_store,
+        }
+
+    def restore_snapshot(self, saved):
+        self.replay_tables = saved["tables"]
+        self.names = snapshot.thaw_keyed(saved["names"])
+        self.ea_overrides = snapshot.thaw_records(saved["ea_overrides"])
+        self.fix_limited = snapshot.thaw_keyed(saved["fix_limited"])
+
+        self.chain_id = saved["chain_id"]
+        self.id_chain = defaultdict(lambda: [], saved["id_chain"])
 
-        self.char_cache = {}
-        self.card_cache = {}
+        self.char_store = saved["char_store"]
+        self.char_store.bind(split_links(self.chara_fields())[1])
+        self.card_store = saved["card_store"]
+        self.card_store.bind(split_links(self.card_fields())[1])
+
+    def replay_query(self, name, query):
+        # Rows are kept in replay_tables so they go into the snapshot.
+        rows = self.replay_tables.get(name)
+        if rows is None:
+            cur = self.hnd.execute(query)
+            rows = self.replay_tables[name] = (cur.description, cur.fetchall())
+        return snapshot.ReplayCursor(*rows)
 
     def prime_from_table(self, table, **kwargs):
-        rows = self.hnd.execute("SELECT * FROM {0}".format(table))
         class_name = table + "_t"
+        cursor = self.replay_query(table, "SELECT * FROM {0}".format(table))
 
-        return self.prime_from_cursor(class_name, rows, **kwargs)
+        return self.prime_from_cursor(class_name, cursor, **kwargs)
 
     def prime_from_cursor(self, typename, cursor, **kwargs):
         the_raw_type, the_type = self.class_cache.get(typename, (None, None))
@@ -340,80 +576,69 @@ class DataCache(object):
             ret[t[0]] = t
         return ret
 
-    def cache_chars(self, idl):
-        lastlen = 0
-        for ids in paginate_id_list(list(set(idl))):
-            if lastlen != len(ids):
-                query = "SELECT * FROM chara_data WHERE base_card_id != 0 AND chara_id IN ({0})".format(",".join("?" * len(ids)))
-                lastlen = len(ids)
-
-            cur = self.hnd.execute(query, ids)
-            for p in self.prime_from_cursor("chara_data_t", cur,
-                kanji_spaced=lambda obj: self.names.get(obj.chara_id).kanji_spaced,
-                kana_spaced=lambda obj:  self.names.get(obj.chara_id).kana_spaced,
-                conventional=lambda obj: self.names.get(obj.chara_id).conventional,
-                translated=lambda obj: self.names.get(obj.chara_id).translated,
-                translated_cht=lambda obj: self.names.get(obj.chara_id).translated_cht,
-                valist=lambda obj: []):
-                self.char_cache[p.chara_id] = p
-                self.primed_this["prm_char"] += 1
-            self.primed_this["prm_char_calls"] += 1
-            cur.close()
-
-    def cache_cards(self, idl):
-        normalized_idl = set()
-        for id in idl:
-            a = self.chain_id.get(id)
-            if a:
-                normalized_idl.add(a)
-
-        idl = list(normalized_idl)
-        query_preload_chars = "SELECT chara_id, id FROM card_data INNER JOIN chara_data USING (chara_id) WHERE base_card_id > 0 AND evolution_id > 0"
-        self.cache_chars([row[0] for row in self.hnd.execute(query_preload_chars) if row[1] in normalized_idl])
-
-        lastlen = 0
-        for page in paginate_id_list(idl):
-            if lastlen != len(page):
-                query = "SELECT * FROM card_data WHERE series_id IN ({0})".format(",".join("?" * len(page)))
-            cur = self.hnd.execute(query, page)
-
-            selected = self.prime_from_cursor("card_data_t", cur,
-                chara=lambda obj: self.char_cache.get(obj.chara_id),
-                has_spread=lambda obj: obj.rarity > 4,
-                has_sign=lambda obj: obj.rarity == 7,
-                name_only=lambda obj: re.match(NAME_ONLY_REGEX, obj.name).group(1),
-                title=lambda obj: re.match(TITLE_ONLY_REGEX, obj.name).group(1) if obj.title_flag else None,
-                skill=lambda obj: self._skills.get(obj.skill_id),
-                lead_skill=lambda obj: self._lead_skills.get(obj.leader_skill_id),
-                rarity_dep=lambda obj: self.rarity_dep.get(obj.rarity),
-                overall_min=lambda obj: obj.vocal_min + obj.dance_min + obj.visual_min,
-                overall_max=lambda obj: obj.vocal_max + obj.dance_max + obj.visual_max,
-                overall_bonus=lambda obj: obj.bonus_vocal + obj.bonus_dance + obj.bonus_visual,
-                valist=lambda obj: [],
-                best_stat=lambda obj: determine_best_stat(obj.vocal_max, obj.visual_max, obj.dance_max))
-
-            for p in selected:
-                self.card_cache[p.id] = p
-                self.primed_this["prm_card"] += 1
-            self.primed_this["prm_card_calls"] += 1
+    def store_from_cursor(self, typename, cursor, key_field, **kwargs):
+        # Same contract as prime_from_cursor, except that the rows end up in a
+        # ColumnStore. kwargs wrapped in link() are resolved on access
+        # instead of being stored.
+        computed, links = split_links(kwargs)
+
+        rows = list(self.prime_from_cursor(typename, cursor, **computed))
+        fields = [x[0] for x in cursor.description] + list(kwargs.keys())
+        return ColumnStore(typename, fields, rows, key_field, links)
+
+    def chara_fields(self):
+        def name_field(field):
+            # names.csv can lag behind a fresh truth; fall back to the raw
+            # name so one missing entry doesn't take down the whole load.
+            return lambda obj: getattr(self.names.get(obj.chara_id), field, obj.name)
+
+        return dict(
+            kanji_spaced=name_field("kanji_spaced"),
+            kana_spaced=name_field("kana_spaced"),
+            conventional=name_field("conventional"),
+            translated=name_field("translated"),
+            translated_cht=name_field("translated_cht"),
+            valist=link(lambda obj: []))
+
+    def card_fields(self):
+        return dict(
+            chara=link(lambda obj: self.char_store.get(obj.chara_id)),
+            has_spread=lambda obj: obj.rarity > 4,
+            has_sign=lambda obj: obj.rarity == 7,
+            name_only=lambda obj: re.match(NAME_ONLY_REGEX, obj.name).group(1),
+            title=lambda obj: re.match(TITLE_ONLY_REGEX, obj.name).group(1) if obj.title_flag else None,
+            skill=link(lambda obj: self._skills.get(obj.skill_id)),
+            lead_skill=link(lambda obj: self._lead_skills.get(obj.leader_skill_id)),
+            rarity_dep=link(lambda obj: self.rarity_dep.get(obj.rarity)),
+            overall_min=lambda obj: obj.vocal_min + obj.dance_min + obj.visual_min,
+            overall_max=lambda obj: obj.vocal_max + obj.dance_max + obj.visual_max,
+            overall_bonus=lambda obj: obj.bonus_vocal + obj.bonus_dance + obj.bonus_visual,
+            valist=link(lambda obj: []),
+            best_stat=lambda obj: determine_best_stat(obj.vocal_max, obj.visual_max, obj.dance_max))
+
+    def load_chars(self):
+        cur = self.hnd.execute("SELECT * FROM chara_data WHERE base_card_id != 0")
+        return self.store_from_cursor("chara_data_t", cur, "chara_id", **self.chara_fields())
+
+    def load_cards(self):
+        # Only chains with an album entry are reachable, same as chain_id.
+        cur = self.hnd.execute("SELECT * FROM card_data WHERE series_id IN "
+            "(SELECT series_id FROM card_data WHERE album_id > 0)")
+        return self.store_from_cursor("card_data_t", cur, "id", **self.card_fields())
 
     def card(self, id):
-        if id not in self.card_cache:
-            self.cache_cards([id])
-
-        return self.card_cache.get(id)
+        return self.card_store.get(id)
 
     def cards(self, ids):
-        needed = [c for c in ids if c not in self.card_cache]
-        if needed:
-            self.cache_cards(needed)
-        return [self.card_cache.get(c) for c in ids]
+        return self.card_store.get_many(ids)
 
     def cards_belonging_to_char(self, id):
         return self.all_chara_id_to_cards().get(id, [])
 
-    @lru_cache(1)
     def all_chara_id_to_cards(self):
+        return self._chara_id_to_cards
+
+    def load_chara_id_to_cards(self):
         ret = defaultdict(lambda: [])
         idl = self.hnd.execute("SELECT card_data.chara_id, card_data.id FROM card_data "
             "INNER JOIN chara_data USING (chara_id) WHERE evolution_id != 0 AND base_card_id != 0 "
@@ -423,16 +648,10 @@ class DataCache(object):
         return ret
 
     def chara(self, id):
-        if id not in self.char_cache:
-            self.cache_chars([id])
-
-        return self.char_cache.get(id)
+        return self.char_store.get(id)
 
     def charas(self, ids):
-        needed = [c for c in ids if c not in self.char_cache]
-        if needed:
-            self.cache_chars(needed)
-        return [self.char_cache.get(c) for c in ids]
+        return self.char_store.get_many(ids)
 
     def chain(self, id):
         series_id = self.chain_id.get(id)
@@ -450,22 +669,10 @@ class DataCache(object):
         return [self._lead_skills.get(id) for id in ids]
 
     def va_data(self, id):
-        va_list = self.hnd.execute("SELECT id, use_type, `index`, voice_flag, discription, 0 AS n1 FROM card_comments WHERE id = ?", (id,))
-        self.primed_this["sel_valist"] += 1
-        ret = list(self.prime_from_cursor("va_data_t", va_list))
-
-        if len(ret) == 0:
-            return []
+        return self.va_index.get(id, ())
 
-        r_va_data_t, va_data_t = self.class_cache.get("va_data_t")
-
-        if ret[0].voice_flag:
-            if id in self.char_cache:
-                yield from extra_va_tables.char_voices(va_data_t, id)
-            else:
-                yield from extra_va_tables.card_voices(va_data_t, id, self.chain_id[id])
-
-        yield from ret
+    def va_data_many(self, ids):
+        return [self.va_index.get(id, ()) for id in ids]
 
     def svx_data(self, id):
         return self.prime_from_cursor("fp_data_t",
@@ -477,8 +684,10 @@ class DataCache(object):
         else:
             return self.kanji_to_name.get(kanji, kanji)
 
-    @lru_cache(1)
     def birthdays(self):
+        return self._birthdays
+
+    def load_birthdays(self):
         return_value = defaultdict(lambda: [])
 
         for month, day, chara_id in self.hnd.execute("SELECT birth_month, birth_day, chara_id FROM chara_data WHERE birth_month + birth_day > 0 AND base_card_id != 0"):
@@ -532,11 +741,10 @@ class DataCache(object):
             ORDER BY life_value""".format(fortype)
         return [(a[0], a[1] - 100, a[2] - 100) for a in self.hnd.execute(query)]
 
-    async def live_gacha_rates(self, gacha_id):
-        cached = self.live_cache["gacha"].get(gacha_id)
-        if cached is not None:
-            return cached
+    def live_gacha_rates(self, gacha_id):
+        return self.live_cache["gacha"].get(gacha_id)
 
+    async def fetch_live_gacha_rates(self, gacha_id):
         if apiclient.is_usable():
             http, api_data = await apiclient.gacha_rates(gacha_id)
         else:
@@ -553,25 +761,102 @@ class DataCache(object):
                 cl = {X[b"card_id"]: float(X[b"charge_odds"]) for X in api_data[b"data"][b"idol_list"].get(k, [])}
                 individual_rate_dict.update(cl)
 
-            self.live_cache["gacha"][gacha_id] = {
+            return {
                 "rates": gacha_rates_t(float(rate_dict[b"r"]), float(rate_dict[b"sr"]), float(rate_dict[b"ssr"])),
                 "indiv": individual_rate_dict,
                 "gacha": gacha_id,
             }
-        finally:
-            return self.live_cache["gacha"].get(gacha_id)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return None
+
+    def smoke_check(self):
+        """Raises if this version doesn't look servable.
+           Run before it is published."""
+        if not self.card_store or not self.char_store:
+            raise RuntimeError("DataCache {0}: no cards or charas".format(self.version))
+
+        for series_id, chain in self.id_chain.items():
+            if self.card(chain[0]) is None:
+                raise RuntimeError("DataCache {0}: chain {1} has no base card".format(self.version, series_id))
+
+    # A request pins the version it started on (see HandlerSyncedWithMaster),
+    # and so does every query on the pool (see run_query), so a version that
+    # is swapped out keeps its handles open until the last of those is done
+    # with it.
+
+    def pin(self):
+        self.pins += 1
+        return self
+
+    def unpin(self):
+        self.pins -= 1
+        if self.retired and self.pins <= 0:
+            self.close()
+
+    def retire(self):
+        self.retired = 1
+        if self.pins <= 0:
+            self.close()
+
+    def close(self):
+        for hnd in self.connections:
+            hnd.close()
 
     def __del__(self):
-        self.hnd.close()
+        # connections may be missing if __init__ failed early
+        for hnd in getattr(self, "connections", ()):
+            hnd.close()
+
+    # Awaitable versions of the query methods, for use from handlers.
+    # Generators are drained on the pool as well.
+
+    def async_available_cards(self, gacha):
+        return self.run_query(self.available_cards, gacha)
+
+    def async_svx_data(self, id):
+        return self.run_query(_materialize, self.svx_data, id)
+
+    def async_potential_birthdays(self, date):
+        return self.run_query(self.potential_birthdays, date)
+
+    def async_fetch_motif_data(self, fortype):
+        return self.run_query(self.fetch_motif_data, fortype)
+
+    def async_fetch_sparkle_data(self, fortype):
+        return self.run_query(self.fetch_sparkle_data, fortype)
 
 def display_app_ver():
     return os.environ.get("VC_APP_VER", "(unset)")
 
 data = None
+# Called with the new DataCache every time one is published.
+version_listeners = []
 
-def hand_over_to_version(res_ver):
+def build_version(res_ver, use_snapshot=1):
+    """Primes and checks a DataCache without publishing it.
+       Safe to run off the IOLoop."""
+    new_data = DataCache(res_ver, use_snapshot)
+    new_data.smoke_check()
+    return new_data
+
+def publish_version(new_data):
     global data
-    data = DataCache(res_ver)
+    old_data, data = data, new_data
+    if old_data is not None and old_data is not new_data:
+        old_data.retire()
+
+    for listener in version_listeners:
+        listener(new_data)
+
+def hand_over_to_version(res_ver):
+    publish_version(build_version(res_ver))
+
+async def async_hand_over_to_version(res_ver):
+    # Requests keep being served from the current version while the new
+    # one primes on a worker thread. The swap itself happens back on the
+    # IOLoop, so handlers never see a half-built DataCache.
+    new_data = await ioloop.IOLoop.current().run_in_executor(None, build_version, res_ver)
+    publish_version(new_data)
 
 def init():
     global data
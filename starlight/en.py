@@ -4,6 +4,8 @@ import os
 import re
 
 NO_STRING_FMT = "<语音 ID {0}:{1}:{2} 没有预设文本，但是你仍然可提交它的翻译。>"
+# Shown instead of a skill description that couldn't be generated.
+UNDESCRIBABLE_SKILL = "（无法生成该技能的描述）"
 
 def westernized_name(chara):
     """Our conventionals are ordered Last First, but project-imas uses First Last."""
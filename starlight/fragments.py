@@ -0,0 +1,51 @@
+import sys
+from collections import OrderedDict, Counter
+
+# Rendered HTML that depends only on master data, e.g. a table cell or a
+# card icon. Each DataCache owns one, so everything in it is dropped
+# together with the version it was rendered from.
+
+class FragmentCache(object):
+    def __init__(self, budget, sizeof=sys.getsizeof):
+        """budget is in bytes, as measured by sizeof.
+           Least recently used fragments are evicted past it."""
+        self.budget = budget
+        self.sizeof = sizeof
+        self.size = 0
+        self.entries = OrderedDict()
+        self.stats = Counter()
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.stats["hit"] += 1
+            self.entries.move_to_end(key)
+        else:
+            self.stats["miss"] += 1
+        return value
+
+    def get_or_make(self, key, make, *args):
+        value = self.get(key)
+        if value is None:
+            value = make(*args)
+            self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        cost = self.sizeof(value)
+        if cost > self.budget:
+            return
+
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= self.sizeof(old)
+
+        self.entries[key] = value
+        self.size += cost
+        while self.size > self.budget:
+            k, v = self.entries.popitem(last=False)
+            self.size -= self.sizeof(v)
+            self.stats["evict"] += 1
+
+    def __len__(self):
+        return len(self.entries)
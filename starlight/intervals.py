@@ -0,0 +1,47 @@
+from bisect import bisect_left, bisect_right
+
+# A static interval index over gacha/event stubs. The distinct start/end
+# dates cut the timeline into segments; for each segment we remember which
+# stubs are running during all of it. A point query is one bisect, and a
+# range query is one bisect per end plus a walk over the segments it spans.
+# Only a handful of things run at once, so storing them per segment
+# is cheap.
+
+class IntervalIndex(object):
+    def __init__(self, stubs):
+        """stubs must be sorted the way results should come out in reverse,
+           i.e. by start_date. Intervals are half-open: [start_date, end_date)."""
+        self.stubs = stubs
+        self.bounds = sorted(set(x.start_date for x in stubs) | set(x.end_date for x in stubs))
+        self.segments = [[] for _ in self.bounds]
+
+        # Walk backwards so each segment ends up in the same order the
+        # linear scan produced (latest first).
+        for n in range(len(stubs) - 1, -1, -1):
+            stub = stubs[n]
+            lo = bisect_left(self.bounds, stub.start_date)
+            hi = bisect_left(self.bounds, stub.end_date)
+            for seg in range(lo, hi):
+                self.segments[seg].append(n)
+
+    def at(self, when):
+        """Everything with start_date <= when < end_date, latest first."""
+        seg = bisect_right(self.bounds, when) - 1
+        if seg < 0:
+            return []
+        return [self.stubs[n] for n in self.segments[seg]]
+
+    def between(self, t1, t2):
+        """Everything running at any point in [t1, t2), latest first."""
+        if t2 <= t1:
+            return []
+
+        lo = max(bisect_right(self.bounds, t1) - 1, 0)
+        hi = bisect_left(self.bounds, t2)
+        if lo + 1 == hi:
+            return [self.stubs[n] for n in self.segments[lo]]
+
+        found = set()
+        for seg in range(lo, hi):
+            found.update(self.segments[seg])
+        return [self.stubs[n] for n in sorted(found, reverse=True)]
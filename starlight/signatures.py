@@ -0,0 +1,41 @@
+import os
+import hmac
+import base64
+import hashlib
+from collections import Counter
+from .fragments import FragmentCache
+
+# Signatures for tlable strings (see webutil.tlable). send_tl checks them,
+# so only strings we actually show can be translated. The master data
+# strings of a version are signed once, when it's loaded
+# (DataCache.tlable_signatures); anything else goes through a small LRU
+# shared by all versions.
+
+TLABLE_SALT = os.getenv("TLABLE_SALT")
+TLABLE_LRU_SIZE = int(os.getenv("TLABLE_LRU_SIZE", "4096"))
+
+_salt = TLABLE_SALT.encode("utf8") if TLABLE_SALT is not None else None
+
+def sign(text):
+    if _salt is None:
+        raise RuntimeError("TLABLE_SALT isn't set")
+    return base64.b64encode(hmac.new(_salt, text.encode("utf8"), hashlib.sha224).digest()).decode("utf8")
+
+def sign_all(strings):
+    if _salt is None:
+        return {}
+    return {text: sign(text) for text in strings}
+
+class SignatureCache(object):
+    def __init__(self, size=TLABLE_LRU_SIZE):
+        self.adhoc = FragmentCache(size, sizeof=lambda _: 1)
+        self.stats = Counter()
+
+    def get(self, text, table):
+        sig = table.get(text)
+        if sig is not None:
+            self.stats["table"] += 1
+            return sig
+
+        self.stats["adhoc"] += 1
+        return self.adhoc.get_or_make(text, sign, text)
@@ -0,0 +1,93 @@
+import os
+import pickle
+import hashlib
+from collections import namedtuple
+
+# Warm-start snapshots of a primed DataCache. A snapshot is a pickle written
+# next to the mdb after priming. It is only used when its key matches,
+# i.e. same truth version, same snapshot format, byte-identical source CSVs
+# and byte-identical source of the code that derives the saved records
+# (see DataCache.snapshot_code); anything else means a full prime. So a
+# deploy that changes how cards or names are computed never gets records
+# made the old way back.
+
+# Bump this whenever the layout of what DataCache puts in a snapshot changes.
+SNAPSHOT_FORMAT = 2
+
+class ReplayCursor(object):
+    """Stands in for a sqlite3 cursor over rows that were saved earlier.
+       Only what prime_from_cursor uses is implemented."""
+    def __init__(self, description, rows):
+        self.description = description
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        pass
+
+def compute_key(version, source_files, code_files=()):
+    hasher = hashlib.sha1("format {0}; version {1}".format(SNAPSHOT_FORMAT, version).encode("utf8"))
+    for path in list(source_files) + list(code_files):
+        hasher.update(path.encode("utf8"))
+        try:
+            with open(path, "rb") as f:
+                hasher.update(f.read())
+        except OSError:
+            hasher.update(b"(missing)")
+    return hasher.hexdigest()
+
+# namedtuple classes made at runtime can't be pickled by reference, so
+# they're stored as (typename, fields, values) and rebuilt on load.
+# Every record of a class shares its _fields tuple, so pickle's memo
+# keeps this compact.
+
+def freeze_records(records):
+    return [(r.__class__.__name__, r._fields, tuple(r)) for r in records]
+
+def thaw_records(frozen):
+    types = {}
+    ret = []
+    for typename, fields, values in frozen:
+        the_type = types.get((typename, fields))
+        if the_type is None:
+            the_type = types[(typename, fields)] = namedtuple(typename, fields)
+        ret.append(the_type(*values))
+    return ret
+
+def freeze_keyed(records):
+    return (list(records.keys()), freeze_records(records.values()))
+
+def thaw_keyed(frozen):
+    keys, values = frozen
+    return dict(zip(keys, thaw_records(values)))
+
+def read(path, key):
+    try:
+        with open(path, "rb") as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print("snapshot: ignoring unreadable {0} ({1!r})".format(path, e))
+        return None
+
+    if not isinstance(snapshot, dict) or snapshot.get("key") != key:
+        print("snapshot: {0} is stale".format(path))
+        return None
+
+    return snapshot
+
+def write(path, snapshot):
+    temp = "{0}.{1}.tmp".format(path, os.getpid())
+    try:
+        with open(temp, "wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, path)
+    except Exception as e:
+        print("snapshot: couldn't write {0} ({1!r})".format(path, e))
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
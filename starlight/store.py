@@ -0,0 +1,132 @@
+import sys
+from array import array
+
+# A read-only, column-oriented table for master data that is loaded once per
+# truth version. Integer, float and bool columns are packed into typed arrays,
+# strings are interned, and rows are handed out as small view objects that
+# look enough like the namedtuples they replace (attribute access, _fields,
+# _asdict, a class named after the table) that templates and the API
+# serializer don't have to care.
+
+class link(object):
+    """Marks a computed field that should be resolved on access instead of
+       stored, e.g. a reference to a row in another table.
+       The function is called with the row view."""
+    def __init__(self, func):
+        self.func = func
+
+def split_links(kwargs):
+    """Splits field kwargs into (stored, links); links are unwrapped."""
+    stored = {k: v for k, v in kwargs.items() if not isinstance(v, link)}
+    links = {k: v.func for k, v in kwargs.items() if isinstance(v, link)}
+    return stored, links
+
+def _pack_column(values):
+    # Returns (storage, decode). decode is None when values can be
+    # returned as-is.
+    if all(type(v) is bool for v in values):
+        return array("b", values), bool
+
+    if all(type(v) is int for v in values):
+        try:
+            return array("q", values), None
+        except OverflowError:
+            return list(values), None
+
+    if all(type(v) is float for v in values):
+        return array("d", values), None
+
+    return [sys.intern(v) if type(v) is str else v for v in values], None
+
+def _column_getter(column, decode):
+    if decode is None:
+        return property(lambda self: column[self._index])
+    else:
+        return property(lambda self: decode(column[self._index]))
+
+def _link_getter(func):
+    return property(lambda self: func(self))
+
+class RowView(object):
+    __slots__ = ("_store", "_index")
+    _fields = ()
+
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+
+    def __iter__(self):
+        return (getattr(self, f) for f in self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __getitem__(self, n):
+        return getattr(self, self._fields[n])
+
+    def __eq__(self, other):
+        return isinstance(other, RowView) and \
+            self._store is other._store and self._index == other._index
+
+    def __hash__(self):
+        return hash((id(self._store), self._index))
+
+    def _asdict(self):
+        return {f: getattr(self, f) for f in self._fields}
+
+    def __repr__(self):
+        return "{0}({1})".format(self.__class__.__name__,
+            ", ".join("{0}={1!r}".format(f, getattr(self, f)) for f in self._fields))
+
+class ColumnStore(object):
+    def __init__(self, typename, fields, rows, key_field, links=None):
+        links = links or {}
+        self.typename = typename
+        self.fields = tuple(fields)
+
+        stored = [f for f in self.fields if f not in links]
+        columns = {f: [] for f in stored}
+        for row in rows:
+            for f, v in zip(stored, row):
+                columns[f].append(v)
+
+        self.columns = {f: _pack_column(columns[f]) for f in stored}
+        self.index = {k: n for n, k in enumerate(columns[key_field])}
+        self.bind(links)
+
+    def bind(self, links):
+        # (Re)builds the row view class. Links are plain functions, so they
+        # have to be supplied again after unpickling.
+        attrs = {"__slots__": (), "_fields": self.fields}
+        for f, (column, decode) in self.columns.items():
+            attrs[f] = _column_getter(column, decode)
+        for f, func in links.items():
+            attrs[f] = _link_getter(func)
+        self.row_type = type(self.typename, (RowView,), attrs)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["row_type"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.row_type = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def get(self, key):
+        n = self.index.get(key)
+        if n is None:
+            return None
+        return self.row_type(self, n)
+
+    def get_many(self, keys):
+        return [self.get(k) for k in keys]
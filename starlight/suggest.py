@@ -0,0 +1,97 @@
+import json
+
+# Name suggestions for the search box. Built once per truth version from
+# DataCache.names.
+#  - completion_map is what /suggest has always returned: search key ->
+#    [display name, chara id], for the client-side fuzzy finder.
+#  - search() answers /suggest?q= on the server. Every distinct character
+#    of a key is indexed, so candidates are the intersection of a few small
+#    sets; those are then checked for a substring or in-order match.
+
+class SuggestIndex(object):
+    def __init__(self, names):
+        self.completion_map = self.build_completion_map(names)
+        self.completion_json = json.dumps(self.completion_map).replace("</", "<\\/")
+
+        self.keys = []
+        self.postings = {}
+        for key, value in self.completion_map.items():
+            folded = key.lower()
+            n = len(self.keys)
+            self.keys.append((folded, value[0], value[1]))
+            for char in set(folded):
+                self.postings.setdefault(char, set()).add(n)
+
+    @staticmethod
+    def build_completion_map(names):
+        # Later sources win when two of them produce the same key.
+        ret = {}
+        for key, value in names.items():
+            ret[value.conventional.lower()] = [value.kanji, key]
+        for key, value in names.items():
+            ret[str(key)] = [value.kanji, key]
+        for key, value in names.items():
+            ret[str(value.kana_spaced)] = [value.kanji, key]
+        for key, value in names.items():
+            ret[str(value.kanji)] = [value.kanji, key]
+        for key, value in names.items():
+            ret[str(value.translated)] = [value.translated + " *", key]
+        for key, value in names.items():
+            ret[str(value.translated_cht)] = [value.translated_cht + " *", key]
+        return ret
+
+    def candidates(self, query):
+        sets = []
+        for char in set(query):
+            posting = self.postings.get(char)
+            if not posting:
+                return ()
+            sets.append(posting)
+
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+    @staticmethod
+    def match(query, key):
+        """Returns (fuzzy, start, span) for the best match of query in key,
+           or None. Lower sorts better, so substrings always come before
+           in-order (fuzzy) matches."""
+        start = key.find(query)
+        if start != -1:
+            return (0, start, len(query))
+
+        # leftmost in-order match, then pull its start as far right as it goes
+        pos = -1
+        for char in query:
+            pos = key.find(char, pos + 1)
+            if pos == -1:
+                return None
+        end = pos
+        for char in reversed(query[:-1]):
+            pos = key.rfind(char, 0, pos)
+        return (1, pos, end - pos + 1)
+
+    def search(self, query, limit=10):
+        """Best matches first, one per chara: [(display name, chara id, key)]"""
+        query = query.lower().strip()
+        if not query:
+            return []
+
+        scored = []
+        for n in self.candidates(query):
+            key, display, chara_id = self.keys[n]
+            m = self.match(query, key)
+            if m is not None:
+                scored.append((m, len(key), key, display, chara_id))
+        scored.sort()
+
+        seen = set()
+        ret = []
+        for m, _, key, display, chara_id in scored:
+            if chara_id in seen:
+                continue
+            seen.add(chara_id)
+            ret.append((display, chara_id, key))
+            if len(ret) >= limit:
+                break
+        return ret
@@ -0,0 +1,59 @@
+import asyncio
+from time import time
+from collections import Counter
+
+# Caches the results of an async fetch function per key.
+# - Entries older than ttl are still served, but the first request to see
+#   one starts a refresh in the background.
+# - Only one fetch per key is ever in flight; everyone who needs the value
+#   meanwhile waits on that one.
+# - A failed or empty fetch never replaces a value we already have.
+
+class TTLCache(object):
+    def __init__(self, fetch, ttl):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.entries = {}
+        self.inflight = {}
+        self.stats = Counter()
+
+    async def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats["miss"] += 1
+            return await self.start_fetch(key)
+
+        value, fetched_at = entry
+        self.stats["hit"] += 1
+        if time() - fetched_at >= self.ttl:
+            self.stats["stale"] += 1
+            self.start_fetch(key)
+        return value
+
+    def start_fetch(self, key):
+        flight = self.inflight.get(key)
+        if flight is None:
+            self.stats["fetch"] += 1
+            flight = self.inflight[key] = asyncio.ensure_future(self.do_fetch(key))
+        else:
+            self.stats["coalesced"] += 1
+        return flight
+
+    async def do_fetch(self, key):
+        try:
+            value = await self.fetch(key)
+        except Exception as e:
+            print("TTLCache: fetch for {0!r} failed ({1!r})".format(key, e))
+            self.stats["error"] += 1
+            value = None
+        finally:
+            del self.inflight[key]
+
+        if value is not None:
+            if key in self.entries:
+                self.stats["refresh"] += 1
+            self.entries[key] = (value, time())
+            return value
+
+        entry = self.entries.get(key)
+        return entry[0] if entry else None
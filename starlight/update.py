@@ -37,13 +37,14 @@ async def update_to_res_ver(res_ver):
         if starlight.data:
             old_path = starlight.transient_data_path("{0}.mdb".format(starlight.data.version))
 
+        loop = ioloop.IOLoop.current()
         try:
-            do_preswitch_tasks(new_path, old_path)
+            await loop.run_in_executor(None, do_preswitch_tasks, new_path, old_path)
         except Exception as e:
             print("do_preswitch_tasks croaked, update aborted.")
             raise
 
-        starlight.hand_over_to_version(res_ver)
+        await starlight.async_hand_over_to_version(res_ver)
         apiclient.ApiClient.shared().res_ver = str(res_ver)
 
 async def async_version_check(release):
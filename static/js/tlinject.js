@@ -135,12 +135,20 @@ function tlinject_activate() {
     }
 
     gTLInjectEnabled = true
-    load_translations(tls, function(tls2) {
+    var apply = function(tls2) {
         for (var i = 0; i < strings.length; i++) {
             strings[i].textContent = tls2[strings[i].textContent] || strings[i].textContent;
         }
         tli_get_banner().innerHTML = TL_ENABLED_TEXT;
-    })
+    }
+
+    // The server may have put this page's translations in already (TL_INLINE).
+    var inline = document.getElementById("tl_inline")
+    if (inline) {
+        apply(JSON.parse(inline.textContent))
+    } else {
+        load_translations(tls, apply)
+    }
 }
 
 function tli_get_banner() {
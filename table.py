@@ -82,7 +82,18 @@ lambda card: enums.lskill_effective_param(card.lead_skill.target_param) if card.
 
 
 class Datum(object):
-    pass
+    # Set this to 0 if make_values depends on anything besides the card.
+    cacheable = 1
+
+    def values_for(self, a_card, data=None):
+        """make_values, but remembered for the rest of the truth version.
+           data is the DataCache a_card came from (the request's pinned
+           version); the fragment must not outlive it."""
+        if not self.cacheable:
+            return self.make_values(a_card)
+
+        return (data or starlight.data).fragments.get_or_make(("datum", self.uid, a_card.id),
+            self.make_values, a_card)
 
 class CardProfile(Datum):
     applicable_filters = [card_attribute, rarity, high_stat]
@@ -157,7 +168,7 @@ class SkillEffect(Datum):
         fmt = """<td class="skill_effect" data-m-proc="{1}" data-m-dur="{2}" data-tw="{3}" data-ef="{4}"> <small>{0}</small> </td>"""
         if a_card.skill:
             return fmt.format(
-                starlight.en.describe_skill_html(a_card.skill),
+                a_card.skill.description_html,
                 a_card.skill.max_chance,
                 a_card.skill.max_duration,
                 a_card.skill.condition,
@@ -196,7 +207,7 @@ class LSkillEffect(Datum):
         return (
             """<td class="lead_skill_effect" data-pup="{1}"> <small>{0}</small> </td>"""
         ).format(
-            starlight.en.describe_lead_skill_html(a_card.lead_skill),
+            a_card.lead_skill.description_html if a_card.lead_skill else starlight.en.describe_lead_skill_html(None),
             a_card.lead_skill.up_value if a_card.lead_skill else 0
         )
 
@@ -253,6 +264,7 @@ class CustomBool(Datum):
     applicable_filters = []
     # can't be selected via url because only A-Za-z is allowed
     uid = "?"
+    cacheable = 0
 
     yes_text = "True"
     no_text = "False"
@@ -273,6 +285,7 @@ class CustomNumber(Datum):
     applicable_filters = []
     # can't be selected via url because only A-Za-z is allowed
     uid = "#"
+    cacheable = 0
 
     format = "{0}"
     header_text = ""
@@ -306,6 +319,15 @@ uid_to_cls = {V.uid: V for V in Datum.__subclasses__()}
 
 # html injection is easier here, please be careful
 
+# Stands in for the rows when generictable.html is rendered for streaming.
+STREAM_MARKER = "<!-- stream rows here -->"
+
+def render_row(filters, categories, a_card, data=None):
+    return """<tr data-cid="{0}" class="row_data {1}">{2}</tr>\n""".format(
+        a_card.id,
+        E(" ".join(filter(bool, (filt.gen_object_class(a_card) for filt in filters)))),
+        "".join(cat.values_for(a_card, data) for cat in categories))
+
 def select_categories(s):
     cats = []
     for uid in s:
@@ -0,0 +1,128 @@
+import os
+import re
+import json
+import zlib
+import gzip
+import struct
+import tornado.web
+import tornado.escape
+
+# Opt-in (TL_INLINE=1): pages carry the translations of their tlable
+# strings, so tlinject.js can apply them without a read_tl round trip.
+# - Keys are collected from the HTML as it goes out, so tlables from cached
+#   fragments and cached responses count too, and looked up in tle's
+#   replica. Until that's loaded, pages go out as they are and the client
+#   asks read_tl like before.
+# - The translations go in a JSON <script> just before MARKER, which
+#   partials/footer.html puts right before each page's tlinject_activate().
+# - The blob goes into the buffer before finish() works out the ETag, so
+#   the default ETag (a hash of the body) covers it. Handlers that compute
+#   theirs from the truth version before rendering mix in etag_revision.
+# - Cached responses are gzipped with a full flush at MARKER, so the
+#   translations can be spliced into the compressed copy without
+#   compressing the whole page again (see spliceable_gzip).
+
+TL_INLINE = os.getenv("TL_INLINE") == "1"
+MARKER = b"<!-- tl_inline -->"
+TLABLE_RE = re.compile(rb'<span class="tlable"[^>]*>([^<]*)</span>')
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+def find_keys(body):
+    return {tornado.escape.xhtml_unescape(m) for m in TLABLE_RE.findall(body)}
+
+def translation_map(handler):
+    """The replica's {key: english}, or None if it isn't loaded."""
+    tle = handler.settings.get("tle")
+    return None if tle is None else tle.replica.entries
+
+def etag_revision(handler):
+    """Something that changes whenever the inlined translations could, for
+       ETags that aren't computed from the body. Empty when not inlining."""
+    if not TL_INLINE or translation_map(handler) is None:
+        return b""
+    replica = handler.settings["tle"].replica
+    return "; tl={0}.{1}".format(replica.max_id, replica.stats["write_through"]).encode("utf8")
+
+def make_blob(entries, keys):
+    found = {k: entries[k] for k in keys if k in entries}
+    # "<" escaped so nothing in a translation can close the script tag.
+    return """<script type="application/json" id="tl_inline">{0}</script>""".format(
+        json.dumps(found, ensure_ascii=0, sort_keys=1).replace("<", "\\u003c")).encode("utf8")
+
+def wants_inline(handler):
+    return (not getattr(handler, "tl_inline_sent", 0)
+        and handler.get_status() == 200
+        and "Content-Encoding" not in handler._headers
+        and handler._headers.get("Content-Type", "").startswith("text/html"))
+
+def process_buffer(handler):
+    """Collects keys from whatever is about to be sent, and puts the blob
+       in front of MARKER once it comes by."""
+    if not wants_inline(handler):
+        return
+
+    entries = translation_map(handler)
+    if entries is None:
+        return
+
+    body = b"".join(handler._write_buffer)
+    keys = handler.tl_inline_keys = getattr(handler, "tl_inline_keys", set()) | find_keys(body)
+    at = body.find(MARKER)
+    if at < 0:
+        return
+
+    handler.tl_inline_sent = 1
+    if keys:
+        handler._write_buffer = [body[:at], make_blob(entries, keys), body[at:]]
+
+def spliceable_gzip(body):
+    """Returns (gzipped, splice): the same as gzip.compress(body), but with
+       a full flush at MARKER, which means nothing after it refers back to
+       anything before it. splice (or None, if there's no MARKER) is what
+       splice_gzip needs to put something there later."""
+    at = body.find(MARKER)
+    if at < 0:
+        return gzip.compress(body), None
+
+    c = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    head = GZIP_HEADER + c.compress(body[:at]) + c.flush(zlib.Z_FULL_FLUSH)
+    tail = c.compress(body[at:]) + c.flush()
+    trailer = struct.pack("<II", zlib.crc32(body), len(body) & 0xFFFFFFFF)
+    return head + tail + trailer, (len(head), at, zlib.crc32(body[:at]), frozenset(find_keys(body)))
+
+def splice_gzip(gzipped, splice, body, insert):
+    """gzip.compress(body[:at] + insert + body[at:]), from gzipped and splice
+       as returned by spliceable_gzip(body)."""
+    gz_at, at, crc, _ = splice
+    c = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    middle = c.compress(insert) + c.flush(zlib.Z_FULL_FLUSH)
+    crc = zlib.crc32(body[at:], zlib.crc32(insert, crc))
+    return b"".join((gzipped[:gz_at], middle, gzipped[gz_at:-8],
+        struct.pack("<II", crc, (len(body) + len(insert)) & 0xFFFFFFFF)))
+
+def cached_gzip(handler, cached):
+    """The gzipped copy of a cached response (see dispatch.ResponseCacheMixin),
+       with translations in it if this request should have them."""
+    entries = translation_map(handler)
+    if cached.splice is None or entries is None or not cached.splice[3]:
+        return cached.gzipped
+
+    handler.tl_inline_sent = 1
+    return splice_gzip(cached.gzipped, cached.splice, cached.body, make_blob(entries, cached.splice[3]))
+
+def install():
+    _super_RequestHandler_flush = tornado.web.RequestHandler.flush
+    def _swizzle_RequestHandler_flush(self, include_footers=False):
+        process_buffer(self)
+        return _super_RequestHandler_flush(self, include_footers)
+    tornado.web.RequestHandler.flush = _swizzle_RequestHandler_flush
+
+    # finish() works out Content-Length before it flushes, so the blob has
+    # to be in by then.
+    _super_RequestHandler_finish = tornado.web.RequestHandler.finish
+    def _swizzle_RequestHandler_finish(self, chunk=None):
+        if chunk is not None:
+            self.write(chunk)
+        process_buffer(self)
+        return _super_RequestHandler_finish(self)
+    tornado.web.RequestHandler.finish = _swizzle_RequestHandler_finish
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import sys
+import os
+
+sys.path.insert(0, os.path.realpath(os.path.dirname(__file__) + "/.."))
+
+from sqlalchemy import inspect, Index
+
+import models
+from models.base import *
+
+# Adds the key_hash column and its index to translation tables created
+# before they existed, then fills it in. Safe to run again; it only
+# touches rows that still have no hash.
+#   usage: backfill_key_hash.py [batch size]
+
+def add_column(engine, table):
+    name = table.__tablename__
+    columns = {c["name"] for c in inspect(engine).get_columns(name)}
+    if "key_hash" not in columns:
+        print("{0}: adding key_hash".format(name))
+        engine.execute("ALTER TABLE {0} ADD COLUMN key_hash VARCHAR(16)".format(name))
+
+    indexes = {i["name"] for i in inspect(engine).get_indexes(name)}
+    index = next(i for i in table.__table__.indexes if list(i.columns) == [table.__table__.c.key_hash])
+    if index.name not in indexes:
+        print("{0}: creating {1}".format(name, index.name))
+        index.create(engine)
+
+def backfill(tsql, table, batch):
+    done = 0
+    while 1:
+        with tsql as s:
+            rows = s.query(table.id, table.key).filter(table.key_hash == None).limit(batch).all()
+            if not rows:
+                break
+
+            s.bulk_update_mappings(table, [{"id": id, "key_hash": key_hash(key or "")} for id, key in rows])
+            s.commit()
+
+        done += len(rows)
+        print("{0}: {1} rows hashed".format(table.__tablename__, done))
+
+def main():
+    if not os.path.exists("./app.py"):
+        print("You can only run this program with the cwd set to the main code directory.")
+
+    batch = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    m = models.TranslationSQL()
+    m.require_key_hash = 0
+    with m:
+        pass
+
+    for table in (TranslationEntry, TranslationCache):
+        add_column(m.engine, table)
+        backfill(m, table, batch)
+
+if __name__ == '__main__':
+    main()
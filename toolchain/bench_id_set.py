@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import sys
+import os
+
+sys.path.insert(0, os.path.realpath(os.path.dirname(__file__) + "/.."))
+
+import json
+import random
+import timeit
+
+from starlight import open_mdb
+
+# Compares the ways of looking up a batch of IDs in the mdb: the old
+# paginated IN (?, ?, ...) lists, one statement over json_each, and one
+# statement joined against a temp table.
+#   usage: bench_id_set.py path/to/xxx.mdb [rounds]
+
+QUERY = "SELECT id, chara_id FROM card_data WHERE id IN {0}"
+
+def paginated(hnd, ids, pagesize=500):
+    ret = []
+    for start in range(0, len(ids), pagesize):
+        page = ids[start:start + pagesize]
+        ret.extend(hnd.execute(QUERY.format("({0})".format(",".join("?" * len(page)))), page))
+    return ret
+
+def with_json_each(hnd, ids):
+    return hnd.execute(QUERY.format("(SELECT value FROM json_each(?))"), (json.dumps(ids),)).fetchall()
+
+def with_temp_table(hnd, ids):
+    hnd.execute("CREATE TEMP TABLE IF NOT EXISTS id_set (id INTEGER PRIMARY KEY)")
+    hnd.execute("DELETE FROM temp.id_set")
+    hnd.executemany("INSERT OR IGNORE INTO temp.id_set VALUES (?)", ((x,) for x in ids))
+    return hnd.execute(QUERY.format("(SELECT id FROM temp.id_set)")).fetchall()
+
+def main():
+    hnd = open_mdb(sys.argv[1])
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    random.seed(573)
+
+    known = [k for k, in hnd.execute("SELECT id FROM card_data")]
+    for count in (10, 500, 5000):
+        ids = random.sample(known, min(count, len(known)))
+        # pad with IDs that don't exist so every size really is that size
+        ids.extend(range(900000000, 900000000 + count - len(ids)))
+
+        expect = sorted(paginated(hnd, ids))
+        print("{0} ids:".format(count))
+        for label, func in (("paginated IN", paginated), ("json_each", with_json_each), ("temp table", with_temp_table)):
+            assert sorted(func(hnd, ids)) == expect
+            t = timeit.timeit(lambda: func(hnd, ids), number=rounds) / rounds
+            print("  {0:<14} {1:9.3f}ms".format(label, t * 1000))
+
+if __name__ == '__main__':
+    main()
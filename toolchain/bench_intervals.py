@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import sys
+import os
+
+sys.path.insert(0, os.path.realpath(os.path.dirname(__file__) + "/.."))
+
+import random
+import timeit
+from datetime import datetime, timedelta
+from collections import namedtuple
+from pytz import utc
+
+from starlight.intervals import IntervalIndex
+
+# Compares IntervalIndex against the linear scan DataCache.gachas/events
+# used to do, on a synthetic history: a few gachas and an event or two
+# running at any time, for the given number of years.
+#   usage: bench_intervals.py [years] [queries]
+
+stub_t = namedtuple("stub_t", ("id", "name", "start_date", "end_date"))
+
+def make_history(years, per_week):
+    origin = utc.localize(datetime(2015, 9, 3, 6))
+    stubs = []
+    for week in range(years * 52):
+        for n in range(per_week):
+            start = origin + timedelta(days=week * 7 + random.randrange(7), hours=random.choice((6, 15)))
+            end = start + timedelta(days=random.choice((3, 5, 7, 8, 14)))
+            stubs.append(stub_t(len(stubs), "stub", start, end))
+    return sorted(stubs, key=lambda x: x.start_date)
+
+def linear_at(stubs, when):
+    select = []
+    for stub in reversed(stubs):
+        if stub.start_date <= when < stub.end_date:
+            select.append(stub)
+    return select
+
+def linear_between(stubs, t1, t2):
+    return [stub for stub in reversed(stubs) if stub.start_date < t2 and t1 < stub.end_date]
+
+def main():
+    years = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    nqueries = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    random.seed(573)
+
+    for label, per_week in (("gachas", 3), ("events", 1)):
+        stubs = make_history(years, per_week)
+        first, last = stubs[0].start_date, stubs[-1].end_date
+        span = (last - first).total_seconds()
+        points = [first + timedelta(seconds=random.uniform(-86400, span + 86400)) for _ in range(nqueries)]
+        ranges = [(t, t + timedelta(days=random.choice((1, 7, 30)))) for t in points]
+
+        t = timeit.default_timer()
+        index = IntervalIndex(stubs)
+        build = timeit.default_timer() - t
+
+        for t1, t2 in ranges:
+            assert index.at(t1) == linear_at(stubs, t1)
+            assert index.between(t1, t2) == linear_between(stubs, t1, t2)
+
+        def per_query(func):
+            return timeit.timeit(func, number=1) / nqueries * 1e6
+
+        print("{0}: {1} stubs over {2} years, index built in {3:.2f}ms".format(label, len(stubs), years, build * 1000))
+        print("  point  linear {0:8.2f}us  index {1:8.2f}us".format(
+            per_query(lambda: [linear_at(stubs, p) for p in points]),
+            per_query(lambda: [index.at(p) for p in points])))
+        print("  range  linear {0:8.2f}us  index {1:8.2f}us".format(
+            per_query(lambda: [linear_between(stubs, *r) for r in ranges]),
+            per_query(lambda: [index.between(*r) for r in ranges])))
+
+if __name__ == '__main__':
+    main()
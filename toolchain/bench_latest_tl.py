@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import sys
+import os
+
+sys.path.insert(0, os.path.realpath(os.path.dirname(__file__) + "/.."))
+
+import random
+import sqlite3
+import tempfile
+import timeit
+
+# Times TranslationSQL.all()/update_caches() against the correlated
+# count-per-row query they used to run, on a synthetic history in SQLite.
+# The old query is quadratic, so it only gets a small prefix of the history.
+#   usage: bench_latest_tl.py [entries] [keys] [old_query_entries]
+
+def make_history(path, nentries, nkeys, table):
+    from models import key_hash
+
+    c = sqlite3.connect(path)
+    c.execute("CREATE TABLE {0} (id INTEGER PRIMARY KEY, key TEXT, key_hash VARCHAR(16), english TEXT, submitter VARCHAR(50), submit_utc INTEGER)".format(table))
+    c.execute("CREATE INDEX ix_{0}_key_hash ON {0} (key_hash)".format(table))
+    ts = 1450000000
+    rows = []
+    for id in range(1, nentries + 1):
+        ts += random.randrange(1, 60)
+        key = "key {0}".format(random.randrange(nkeys))
+        # every so often someone "translates" a key back to itself
+        rows.append((id, key, key_hash(key), key if random.random() < 0.05 else "tl {0}".format(id), "127.0.0.1", ts))
+    c.executemany("INSERT INTO {0} VALUES (?, ?, ?, ?, ?, ?)".format(table), rows)
+    c.commit()
+    c.close()
+
+def old_latest(tsql):
+    from sqlalchemy import func
+    from sqlalchemy.orm import aliased
+    from models import TranslationEntry
+
+    with tsql as s:
+        transient = aliased(TranslationEntry)
+        return s.query(TranslationEntry).filter(
+            s.query(func.count(transient.id))
+            .filter(transient.submit_utc >= TranslationEntry.submit_utc)
+            .filter(transient.key == TranslationEntry.key)
+            .order_by(transient.id.desc())
+            .correlate(TranslationEntry)
+            .as_scalar() == 1).all()
+
+def timed(func, *args):
+    t = timeit.default_timer()
+    ret = func(*args)
+    return ret, timeit.default_timer() - t
+
+def main():
+    nentries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    nkeys = int(sys.argv[2]) if len(sys.argv) > 2 else nentries // 5
+    nold = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+    random.seed(573)
+
+    tmp = tempfile.mkdtemp()
+    os.environ["DATABASE_CONNECT"] = url = "sqlite:///" + os.path.join(tmp, "big.db")
+    os.environ.setdefault("TLE_TABLE_PREFIX", "ss")
+    import models
+
+    table = models.TranslationEntry.__tablename__
+    make_history(os.path.join(tmp, "big.db"), nentries, nkeys, table)
+    make_history(os.path.join(tmp, "small.db"), nold, max(nold // 5, 1), table)
+
+    small = models.TranslationSQL("sqlite:///" + os.path.join(tmp, "small.db"))
+    old, t_old = timed(old_latest, small)
+    new, t_new = timed(small.all)
+    assert sorted(x.id for x in old) == sorted(x.id for x in new)
+    print("{0} entries: correlated {1:.2f}s, single pass {2:.3f}s".format(nold, t_old, t_new))
+
+    big = models.TranslationSQL(url)
+    latest, t = timed(big.all)
+    print("{0} entries, {1} keys: all() {2:.2f}s ({3} rows)".format(nentries, nkeys, t, len(latest)))
+    _, t = timed(big.update_caches)
+    print("  update_caches full        {0:.2f}s".format(t))
+
+    for batch in (100, 10000):
+        with big as s:
+            ts = s.query(models.func.max(models.TranslationEntry.submit_utc)).scalar()
+            s.add_all([models.TranslationEntry(key="key {0}".format(random.randrange(nkeys * 2)),
+                english="new", submitter="127.0.0.1", submit_utc=ts + n + 1) for n in range(batch)])
+            s.commit()
+        touched, t = timed(big.update_caches, 1)
+        print("  update_caches incremental {0:.2f}s ({1} new entries, {2} keys redone)".format(t, batch, touched))
+
+    with big as s:
+        incremental = sorted((x.key, x.english) for x in s.query(models.TranslationCache))
+    big.update_caches()
+    with big as s:
+        full = sorted((x.key, x.english) for x in s.query(models.TranslationCache))
+    assert incremental == full
+    print("  incremental result matches a full rebuild")
+
+if __name__ == '__main__':
+    main()
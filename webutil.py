@@ -1,15 +1,14 @@
 import tornado.escape
-import hashlib
 import base64
-import os
 import starlight
 import enums
 import struct
-import hmac
+
+tlable_signatures = starlight.signatures.SignatureCache()
 
 def tlable_make_assr(text):
-    salt = os.getenv("TLABLE_SALT").encode("utf8")
-    return base64.b64encode(hmac.new(salt, text.encode("utf8"), hashlib.sha224).digest()).decode("utf8")
+    data = starlight.data
+    return tlable_signatures.get(text, data.tlable_signatures if data is not None else {})
 
 def tlable(text, write=1):
     text = text.replace("\n", " ")
@@ -23,8 +22,26 @@ def tlable(text, write=1):
 def icon(css_class):
     return """<div class="icon icon_{0}"></div>""".format(css_class)
 
-def icon_ex(card_id, is_lowbw=0, collapsible=0, classes=""):
-    rec = starlight.data.card(card_id)
+def cached_fragment(handler, key, template_name, **kwargs):
+    """Renders a template that only depends on master data (and the locale),
+       reusing the result for the rest of the truth version."""
+    key = ("template", template_name, handler.locale.code) + tuple(key)
+    # The version the request is pinned to, which is where its cards came
+    # from, even if a newer one was published while it was waiting.
+    data = getattr(handler, "data", None) or starlight.data
+    return data.fragments.get_or_make(key,
+        lambda: handler.render_string(template_name, **dict(handler.settings, **kwargs)))
+
+def icon_ex(card_id, is_lowbw=0, collapsible=0, classes="", data=None):
+    # Looked up and stored in the same version, so one published in
+    # between can't end up with the other's HTML.
+    data = data or starlight.data
+    return data.fragments.get_or_make(
+        ("icon_ex", card_id, bool(is_lowbw), bool(collapsible), classes),
+        make_icon_ex, data, card_id, is_lowbw, collapsible, classes)
+
+def make_icon_ex(data, card_id, is_lowbw, collapsible, classes):
+    rec = data.card(card_id)
     if not rec:
         btext = "(?) bug:{0}".format(card_id)
         ish = """<div class="profile {1}">